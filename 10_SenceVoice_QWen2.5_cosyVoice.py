@@ -1,4 +1,4 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from cosyvoice.cli.cosyvoice import CosyVoice
 from cosyvoice.utils.file_utils import load_wav
 from funasr import AutoModel
@@ -6,6 +6,7 @@ import torchaudio
 import pygame
 import time
 import sys
+import threading
 import sounddevice as sd
 from scipy.io.wavfile import write
 import numpy as np
@@ -126,18 +127,12 @@ while(1):
     )
     model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
 
-    generated_ids = model.generate(
-        **model_inputs,
-        max_new_tokens=512,
-    )
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-    ]
-
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    # Qwen 在后台线程中流式生成，CosyVoice 每收到一句完整的文本就开始合成，无需等待整段回答生成完毕
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    generation_thread = threading.Thread(target=model.generate, kwargs=dict(**model_inputs, max_new_tokens=512, streamer=streamer))
+    generation_thread.start()
 
     print("Input:", prompt)
-    print("Answer:", response)
 
     # --- 答复输出文件夹 ---
     folder_path = "./out_answer/"
@@ -145,12 +140,9 @@ while(1):
 
     # ['中文女', '中文男', '日语男', '粤语女', '英文女', '英文男', '韩语女']
     # change stream=True for chunk stream inference
-    index_out = 0
-    for i, j in enumerate(cosyvoice.inference_sft(f'{response}', '中文女', stream=False)):
+    # inference_sft 直接接收 streamer，每合成完一句就立即播放
+    for i, j in enumerate(cosyvoice.inference_sft(streamer, '中文女', stream=False)):
         torchaudio.save('{}/sft_{}.wav'.format(folder_path,i), j['tts_speech'], 22050)
-        index_out += 1
-        # play_audio('sft_{}.wav'.format(i))
-
-    for idx in range(index_out):
-        play_audio('{}/sft_{}.wav'.format(folder_path,idx))
+        play_audio('{}/sft_{}.wav'.format(folder_path,i))
+    generation_thread.join()
 
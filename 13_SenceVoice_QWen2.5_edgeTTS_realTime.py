@@ -9,7 +9,7 @@ import webrtcvad
 import os
 import threading
 from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, AutoProcessor
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from qwen_vl_utils import process_vision_info
 import torch
 from funasr import AutoModel
@@ -18,6 +18,7 @@ import edge_tts
 import asyncio
 from time import sleep
 import langid
+from cosyvoice.utils.frontend_utils import split_paragraph_stream
 from langdetect import detect
 
 # --- 配置huggingFace国内镜像 ---
@@ -252,24 +253,10 @@ def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
     )
     model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
 
-    generated_ids = model.generate(
-        **model_inputs,
-        max_new_tokens=512,
-    )
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-    ]
-
-    output_text = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-
-    print("answer", output_text)
-
-    # 输入文本
-    text = output_text
-    # 语种识别 -- langid
-    language, confidence = langid.classify(text)
-    # 语种识别 -- langdetect 
-    # language = detect(text).split("-")[0]
+    # Qwen 在后台线程中流式生成，每生成完一句就立即合成播放，无需等待整段回答生成完毕
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    generation_thread = threading.Thread(target=model.generate, kwargs=dict(**model_inputs, max_new_tokens=512, streamer=streamer))
+    generation_thread.start()
 
     language_speaker = {
     "ja" : "ja-JP-NanamiNeural",            # ok
@@ -280,15 +267,25 @@ def Inference(TEMP_AUDIO_FILE=f"{OUTPUT_DIR}/audio_0.wav"):
     "en" : "en-US-AnaNeural",               # ok
     }
 
-    if language not in language_speaker.keys():
-        used_speaker = "zh-CN-XiaoyiNeural"
-    else:
-        used_speaker = language_speaker[language]
-        print("检测到语种：", language, "使用音色：", language_speaker[language])
-
     global audio_file_count
-    asyncio.run(amain(text, used_speaker, os.path.join(folder_path,f"sft_{audio_file_count}.mp3")))
-    play_audio(f'{folder_path}/sft_{audio_file_count}.mp3')
+    output_text = ""
+    used_speaker = None
+    for segment_idx, text in enumerate(split_paragraph_stream(streamer, tokenizer.encode)):
+        output_text += text
+        print("answer segment", text)
+        if used_speaker is None:
+            # 语种识别 -- langid，以第一句为准，整段回答使用同一音色
+            language, confidence = langid.classify(text)
+            if language not in language_speaker.keys():
+                used_speaker = "zh-CN-XiaoyiNeural"
+            else:
+                used_speaker = language_speaker[language]
+                print("检测到语种：", language, "使用音色：", language_speaker[language])
+        asyncio.run(amain(text, used_speaker, os.path.join(folder_path,f"sft_{audio_file_count}_{segment_idx}.mp3")))
+        play_audio(f'{folder_path}/sft_{audio_file_count}_{segment_idx}.mp3')
+    generation_thread.join()
+
+    print("answer", output_text)
 
 # 主函数
 if __name__ == "__main__":
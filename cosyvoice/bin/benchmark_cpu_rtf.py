@@ -0,0 +1,122 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.utils.common import set_cpu_threads
+
+PROFILE_OPTIONS = ('fp32', 'bf16', 'int8', 'jit', 'onnx', 'onnx_hift')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark cpu rtf of cosyvoice inference profiles, hide gpus by CUDA_VISIBLE_DEVICES=')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M',
+                        help='local path')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女',
+                        help='sft speaker id')
+    parser.add_argument('--profiles',
+                        type=str,
+                        default='fp32,fp32+jit,fp32+onnx+onnx_hift,bf16,int8',
+                        help='comma separated profiles, each joins {} by +'.format('/'.join(PROFILE_OPTIONS)))
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=0,
+                        help='torch and onnxruntime intra-op threads, 0 splits the cores among num_workers')
+    parser.add_argument('--num_interop_threads',
+                        type=int,
+                        default=1,
+                        help='torch inter-op threads, 0 keeps the torch default')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=1,
+                        help='number of worker processes the node is shared with')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='stream inference, also report first chunk latency')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='number of timed runs of each profile')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed of every run')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def synthesize(cosyvoice, args):
+    torch.manual_seed(args.seed)
+    start_time = time.time()
+    first_chunk_latency, speech_len = None, 0
+    for model_output in cosyvoice.inference_sft(args.tts_text, args.spk_id, stream=args.stream):
+        if first_chunk_latency is None:
+            first_chunk_latency = time.time() - start_time
+        speech_len += model_output['tts_speech'].shape[1] / 22050
+    return time.time() - start_time, first_chunk_latency, speech_len
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if torch.cuda.is_available():
+        logging.warning('cuda is visible, the models run on gpu, hide it by CUDA_VISIBLE_DEVICES= to benchmark cpu')
+
+    # inter-op threads can only be set once, before any model runs
+    num_threads = set_cpu_threads(args.num_threads, args.num_interop_threads, args.num_workers)
+    results = []
+    for profile in args.profiles.split(','):
+        options = profile.split('+')
+        assert all(option in PROFILE_OPTIONS for option in options), 'unknown option in profile {}'.format(profile)
+        cosyvoice = CosyVoice(args.model_dir, load_jit='jit' in options, load_onnx='onnx' in options, fp16=False,
+                              onnx_intra_op_num_threads=num_threads, load_onnx_hift='onnx_hift' in options,
+                              bf16='bf16' in options, quantize='int8' in options)
+        # warmup
+        synthesize(cosyvoice, args)
+        elapsed, latency, speech_len = 0, 0, 0
+        for _ in range(args.num_runs):
+            run_elapsed, run_latency, run_speech_len = synthesize(cosyvoice, args)
+            elapsed, latency, speech_len = elapsed + run_elapsed, latency + run_latency, speech_len + run_speech_len
+        results.append((profile, elapsed / speech_len, latency / args.num_runs, speech_len / args.num_runs))
+        del cosyvoice
+
+    print('{} torch threads, {} inter-op threads'.format(torch.get_num_threads(), torch.get_num_interop_threads()))
+    print('{:>24} {:>8} {:>20} {:>12}'.format('profile', 'rtf', 'first chunk ms', 'speech s'))
+    for profile, rtf, latency, speech_len in results:
+        print('{:>24} {:>8.4f} {:>20.1f} {:>12.2f}'.format(profile, rtf, latency * 1000, speech_len))
+
+
+if __name__ == '__main__':
+    main()
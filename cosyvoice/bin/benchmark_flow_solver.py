@@ -0,0 +1,125 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark rtf and mel distance of flow decoding ode solvers')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M',
+                        help='local path')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女',
+                        help='sft speaker id')
+    parser.add_argument('--solvers',
+                        type=str,
+                        default='euler:10,euler:6,euler:4,heun:5,midpoint:5,multistep:6,multistep:4,cached:10,cached:6',
+                        help='comma separated solver:n_timesteps to benchmark, euler:10 is the reference')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5,
+                        help='number of timed runs of each solver')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='noise seed, all solvers start from the same noise')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def flow_inference(model, model_input, token, n_timesteps, solver, seed):
+    torch.manual_seed(seed)
+    tts_mel, _ = model.flow.inference(token=token.to(model.device),
+                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(model.device),
+                                      prompt_token=model_input['flow_prompt_speech_token'].to(model.device),
+                                      prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]],
+                                                                    dtype=torch.int32).to(model.device),
+                                      prompt_feat=model_input['prompt_speech_feat'].to(model.device),
+                                      prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(model.device),
+                                      embedding=model_input['flow_embedding'].to(model.device),
+                                      flow_cache=torch.zeros(1, 80, 0, 2).to(model.device),
+                                      n_timesteps=n_timesteps,
+                                      solver=solver)
+    return tts_mel
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
+    model = cosyvoice.model
+    text = cosyvoice.frontend.text_normalize(args.tts_text, split=False)
+    model_input = cosyvoice.frontend.frontend_sft(text, args.spk_id)
+    model_input.setdefault('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32))
+    model_input.setdefault('prompt_speech_feat', torch.zeros(1, 0, 80))
+    # speech tokens are decoded once, every solver converts the same tokens
+    torch.manual_seed(args.seed)
+    token = list(model.llm.inference(text=model_input['text'].to(model.device),
+                                     text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(model.device),
+                                     prompt_text=torch.zeros(1, 0, dtype=torch.int32).to(model.device),
+                                     prompt_text_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                     prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32).to(model.device),
+                                     prompt_speech_token_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                     embedding=model_input['llm_embedding'].to(model.device)))
+    token = torch.tensor(token, dtype=torch.int32).unsqueeze(dim=0)
+
+    reference = flow_inference(model, model_input, token, 10, 'euler', args.seed)
+    speech_len = reference.shape[2] * 256 / 22050
+    print('{} speech tokens, {:.2f}s speech'.format(token.shape[1], speech_len))
+    print('{:>16} {:>8} {:>12} {:>16}'.format('solver', 'nfe', 'flow rtf', 'mel l1 to ref'))
+    for config in args.solvers.split(','):
+        solver, n_timesteps = config.split(':')
+        n_timesteps = int(n_timesteps)
+        nfe = {'heun': 2 * n_timesteps, 'midpoint': 2 * n_timesteps, 'cached': (n_timesteps + 1) // 2}.get(solver, n_timesteps)
+        # warmup
+        tts_mel = flow_inference(model, model_input, token, n_timesteps, solver, args.seed)
+        synchronize(model.device)
+        start_time = time.time()
+        for _ in range(args.num_runs):
+            tts_mel = flow_inference(model, model_input, token, n_timesteps, solver, args.seed)
+        synchronize(model.device)
+        rtf = (time.time() - start_time) / args.num_runs / speech_len
+        distance = (tts_mel - reference).abs().mean().item()
+        print('{:>16} {:>8} {:>12.4f} {:>16.4f}'.format(config, nfe, rtf, distance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.transformer.kv_cache import KVCache
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark per token latency of llm decoding with concat and preallocated kv cache')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M',
+                        help='local path')
+    parser.add_argument('--prompt_len',
+                        type=int,
+                        default=200,
+                        help='length of the prefill input')
+    parser.add_argument('--max_len',
+                        type=int,
+                        default=1500,
+                        help='number of decoded tokens')
+    parser.add_argument('--interval',
+                        type=int,
+                        default=100,
+                        help='report average latency every interval tokens')
+    parser.add_argument('--fp16',
+                        action='store_true',
+                        help='run llm in fp16')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def decode(llm, lm_input, max_len, inplace):
+    device = lm_input.device
+    att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=device)).to(torch.bool)
+    _, att_cache, cnn_cache = llm.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                                    att_cache=torch.zeros((0, 0, 0, 0), device=device),
+                                                    cnn_cache=torch.zeros((0, 0, 0, 0), device=device),
+                                                    att_mask=att_mask)
+    kv_cache = KVCache(att_cache, max_len=att_cache.size(2) + max_len) if inplace else None
+    offset = lm_input.shape[1]
+    att_mask = torch.ones((0, 0, 0), dtype=torch.bool)
+    latency = []
+    tokens = torch.randint(0, llm.speech_token_size, (max_len,), device=device)
+    for i in range(max_len):
+        xs = llm.speech_embedding.weight[tokens[i]].reshape(1, 1, -1)
+        synchronize(device)
+        start_time = time.time()
+        if inplace:
+            kv_cache.forward_chunk(llm.llm, xs, offset=offset, att_mask=att_mask)
+        else:
+            _, att_cache, cnn_cache = llm.llm.forward_chunk(xs, offset=offset, required_cache_size=-1,
+                                                            att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+        synchronize(device)
+        latency.append(time.time() - start_time)
+        offset += 1
+    return latency
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=args.fp16)
+    llm = cosyvoice.model.llm
+    device = cosyvoice.model.device
+    dtype = torch.float16 if args.fp16 else torch.float32
+    lm_input = torch.randn((1, args.prompt_len, llm.llm_input_size), dtype=dtype, device=device)
+
+    # warmup
+    decode(llm, lm_input, args.interval, inplace=False)
+    decode(llm, lm_input, args.interval, inplace=True)
+    concat_latency = decode(llm, lm_input, args.max_len, inplace=False)
+    inplace_latency = decode(llm, lm_input, args.max_len, inplace=True)
+
+    print('{:>16} {:>16} {:>16}'.format('cache length', 'concat ms/token', 'inplace ms/token'))
+    for start in range(0, args.max_len, args.interval):
+        end = min(start + args.interval, args.max_len)
+        concat_ms = sum(concat_latency[start:end]) / (end - start) * 1000
+        inplace_ms = sum(inplace_latency[start:end]) / (end - start) * 1000
+        print('{:>16} {:>16.3f} {:>16.3f}'.format('{}-{}'.format(args.prompt_len + start, args.prompt_len + end), concat_ms, inplace_ms))
+
+
+if __name__ == '__main__':
+    main()
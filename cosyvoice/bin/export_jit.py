@@ -32,6 +32,11 @@ def get_args():
                         type=str,
                         default='pretrained_models/CosyVoice-300M',
                         help='local path')
+    parser.add_argument('--dtype',
+                        type=str,
+                        default='fp16',
+                        choices=['fp16', 'bf16', 'fp32'],
+                        help='dtype of the llm models, fp16 for gpu, bf16 or fp32 for cpu')
     args = parser.parse_args()
     print(args)
     return args
@@ -46,21 +51,22 @@ def main():
     torch._C._jit_set_profiling_mode(False)
     torch._C._jit_set_profiling_executor(False)
 
-    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False)
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32}[args.dtype]
 
     # 1. export llm text_encoder
-    llm_text_encoder = cosyvoice.model.llm.text_encoder.half()
+    llm_text_encoder = cosyvoice.model.llm.text_encoder.to(dtype)
     script = torch.jit.script(llm_text_encoder)
     script = torch.jit.freeze(script)
     script = torch.jit.optimize_for_inference(script)
-    script.save('{}/llm.text_encoder.fp16.zip'.format(args.model_dir))
+    script.save('{}/llm.text_encoder.{}.zip'.format(args.model_dir, args.dtype))
 
     # 2. export llm llm
-    llm_llm = cosyvoice.model.llm.llm.half()
+    llm_llm = cosyvoice.model.llm.llm.to(dtype)
     script = torch.jit.script(llm_llm)
-    script = torch.jit.freeze(script, preserved_attrs=['forward_chunk'])
+    script = torch.jit.freeze(script, preserved_attrs=['forward_chunk', 'forward_chunk_inplace'])
     script = torch.jit.optimize_for_inference(script)
-    script.save('{}/llm.llm.fp16.zip'.format(args.model_dir))
+    script.save('{}/llm.llm.{}.zip'.format(args.model_dir, args.dtype))
 
     # 3. export flow encoder
     flow_encoder = cosyvoice.model.flow.encoder
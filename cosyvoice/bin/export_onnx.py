@@ -40,6 +40,24 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+def get_dummy_hift_input(batch_size, mel_len, cache_len, hift, device):
+    speech_feat = torch.rand((batch_size, 80, mel_len), dtype=torch.float32, device=device) * 10 - 10
+    cache_source = torch.rand((batch_size, 1, cache_len), dtype=torch.float32, device=device) * 0.2 - 0.1
+    phase_vec, noise = hift.m_source.l_sin_gen.sample_random(batch_size, mel_len * int(hift.f0_upsamp.scale_factor), device)
+    return speech_feat, cache_source, phase_vec, noise
+
+
+class HiFTSynthesizer(torch.nn.Module):
+    """Export wrapper of HiFTGenerator.synthesize, which takes the random values of the source as inputs."""
+
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, speech_feat, cache_source, phase_vec, noise):
+        return self.hift.synthesize(speech_feat, cache_source, phase_vec, noise)
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
@@ -107,6 +125,45 @@ def main():
         output_onnx = estimator_onnx.run(None, ort_inputs)[0]
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
 
+    # 3. export hift, weight norm is folded and stft/istft are exported as convolutions
+    hift = cosyvoice.model.hift
+    hift.remove_weight_norm()
+    hift_synthesizer = HiFTSynthesizer(hift).eval()
+    speech_feat, cache_source, phase_vec, noise = get_dummy_hift_input(1, 256, 5120, hift, device)
+    torch.onnx.export(
+        hift_synthesizer,
+        (speech_feat, cache_source, phase_vec, noise),
+        '{}/hift.fp32.onnx'.format(args.model_dir),
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['speech_feat', 'cache_source', 'phase_vec', 'noise'],
+        output_names=['tts_speech', 'tts_source'],
+        dynamic_axes={
+            'speech_feat': {0: 'batch_size', 2: 'mel_len'},
+            'cache_source': {0: 'batch_size', 2: 'cache_len'},
+            'phase_vec': {0: 'batch_size'},
+            'noise': {0: 'batch_size', 2: 'source_len'},
+            'tts_speech': {0: 'batch_size', 1: 'speech_len'},
+            'tts_source': {0: 'batch_size', 2: 'source_len'},
+        }
+    )
+
+    # 4. test hift computation consistency, with and without cache source
+    hift_onnx = onnxruntime.InferenceSession('{}/hift.fp32.onnx'.format(args.model_dir), sess_options=option, providers=providers)
+    for _ in tqdm(range(10)):
+        speech_feat, cache_source, phase_vec, noise = get_dummy_hift_input(1, random.randint(32, 512), random.choice([0, 5120]), hift, device)
+        with torch.no_grad():
+            output_pytorch = hift_synthesizer(speech_feat, cache_source, phase_vec, noise)[0]
+        ort_inputs = {
+            'speech_feat': speech_feat.cpu().numpy(),
+            'cache_source': cache_source.cpu().numpy(),
+            'phase_vec': phase_vec.cpu().numpy(),
+            'noise': noise.cpu().numpy()
+        }
+        output_onnx = hift_onnx.run(None, ort_inputs)[0]
+        torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-3)
+
 
 if __name__ == "__main__":
     main()
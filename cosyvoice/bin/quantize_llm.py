@@ -0,0 +1,199 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import numpy as np
+import pyarrow.parquet as pq
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.utils.common import IGNORE_ID
+from cosyvoice.utils.quantize_utils import quantize_linear_dynamic, split_quantize_units
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='calibrate dynamic int8 quantization of the llm and report its accuracy and rtf against fp32')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M',
+                        help='local path')
+    parser.add_argument('--data_list',
+                        type=str,
+                        required=True,
+                        help='parquet data list of the calibration set, e.g. data/dev.data.list')
+    parser.add_argument('--num_utts',
+                        type=int,
+                        default=20,
+                        help='number of calibration utterances')
+    parser.add_argument('--max_kl',
+                        type=float,
+                        default=0.02,
+                        help='max mean kl divergence of int8 to fp32 next token distributions, the most sensitive units stay in float until it holds')
+    parser.add_argument('--num_decode_utts',
+                        type=int,
+                        default=5,
+                        help='number of calibration utterances decoded to measure rtf')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='selected units and report, defaults to model_dir/llm.int8.json which CosyVoice(load_int8_llm=True) loads')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='sampling seed of rtf decoding')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def load_calibration_set(data_list, num_utts, frontend):
+    """Read the first num_utts utterances of the parquet files in data_list as batches of one utterance."""
+    with open(data_list, 'r', encoding='utf8') as f:
+        parquet_files = [line.strip() for line in f if line.strip() != '']
+    batches = []
+    for parquet_file in parquet_files:
+        df = pq.read_table(parquet_file, columns=['utt', 'text', 'utt_embedding', 'speech_token']).to_pandas()
+        for i in range(len(df)):
+            text_token, text_token_len = frontend._extract_text_token(df.loc[i, 'text'])
+            speech_token = torch.tensor(np.array(df.loc[i, 'speech_token']), dtype=torch.int32).unsqueeze(dim=0)
+            batches.append({'utt': df.loc[i, 'utt'],
+                            'text_token': text_token.cpu(),
+                            'text_token_len': text_token_len.cpu(),
+                            'speech_token': speech_token,
+                            'speech_token_len': torch.tensor([speech_token.shape[1]], dtype=torch.int32),
+                            'embedding': torch.tensor(np.array(df.loc[i, 'utt_embedding']), dtype=torch.float32).unsqueeze(dim=0)})
+            if len(batches) == num_utts:
+                return batches
+    return batches
+
+
+@torch.inference_mode()
+def teacher_forcing(llm, batches):
+    """Next token log probs and targets of the predicted positions of every utterance."""
+    outputs = []
+    for batch in batches:
+        logits, lm_target = llm.forward_logits(batch, torch.device('cpu'))
+        mask = lm_target != IGNORE_ID
+        outputs.append((logits[mask].log_softmax(dim=-1), lm_target[mask]))
+    return outputs
+
+
+def compare(reference, outputs):
+    """Mean kl divergence to the reference distributions, top1 agreement with the reference and accuracy of the targets."""
+    kl, agreement, correct, total = 0, 0, 0, 0
+    for (reference_logp, target), (logp, _) in zip(reference, outputs):
+        kl += F.kl_div(logp, reference_logp, reduction='sum', log_target=True).item()
+        agreement += (logp.argmax(dim=-1) == reference_logp.argmax(dim=-1)).sum().item()
+        correct += (logp.argmax(dim=-1) == target).sum().item()
+        total += target.numel()
+    return {'kl': kl / total, 'top1_agreement': agreement / total, 'acc': correct / total}
+
+
+def decode_rtf(llm, batches, token_rate, seed):
+    """Per token latency in ms and rtf of free running decoding, the speech tokens come at token_rate per second."""
+    elapsed, num_tokens = 0, 0
+    for batch in batches:
+        torch.manual_seed(seed)
+        start_time = time.time()
+        for _ in llm.inference(text=batch['text_token'],
+                               text_len=batch['text_token_len'],
+                               prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+                               prompt_text_len=torch.tensor([0], dtype=torch.int32),
+                               prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
+                               prompt_speech_token_len=torch.tensor([0], dtype=torch.int32),
+                               embedding=batch['embedding']):
+            num_tokens += 1
+        elapsed += time.time() - start_time
+    return elapsed / num_tokens * 1000, elapsed / (num_tokens / token_rate)
+
+
+def linear_weight_mb(model):
+    """Size of the Linear weights of model, dynamic int8 Linear layers count one byte per weight."""
+    num_bytes = 0
+    for module in model.modules():
+        if type(module) is torch.nn.Linear:
+            num_bytes += module.weight.numel() * module.weight.element_size()
+        elif isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            num_bytes += module.weight().numel()
+    return num_bytes / 1024 / 1024
+
+
+def quantize(llm, units):
+    quantized = copy.deepcopy(llm)
+    quantize_linear_dynamic(quantized, units)
+    return quantized
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    assert torch.cuda.is_available() is False, 'dynamic int8 runs on cpu, hide gpus by CUDA_VISIBLE_DEVICES='
+
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
+    llm = cosyvoice.model.llm
+    batches = load_calibration_set(args.data_list, args.num_utts, cosyvoice.frontend)
+    logging.info('{} calibration utterances'.format(len(batches)))
+    reference = teacher_forcing(llm, batches)
+
+    # 1. sensitivity of every unit quantized alone
+    units = split_quantize_units(llm, ['text_encoder', 'text_encoder_affine_layer', 'llm', 'llm_decoder'])
+    sensitivity = {}
+    for unit in tqdm(units):
+        sensitivity[unit] = compare(reference, teacher_forcing(quantize(llm, [unit]), batches))['kl']
+
+    # 2. quantize all units, keep the most sensitive ones in float until the kl is within max_kl
+    selected = sorted(units, key=lambda unit: sensitivity[unit])
+    while True:
+        quantized = quantize(llm, selected)
+        int8_metrics = compare(reference, teacher_forcing(quantized, batches))
+        if int8_metrics['kl'] <= args.max_kl or len(selected) == 0:
+            break
+        logging.info('kl {:.4f} > {}, keep {} in float'.format(int8_metrics['kl'], args.max_kl, selected[-1]))
+        selected.pop()
+    selected = [unit for unit in units if unit in selected]
+
+    # 3. report
+    token_rate = cosyvoice.model.flow.input_frame_rate
+    report = {}
+    for name, model, metrics in [('fp32', llm, compare(reference, reference)), ('int8', quantized, int8_metrics)]:
+        ms_per_token, rtf = decode_rtf(model, batches[:args.num_decode_utts], token_rate, args.seed)
+        report[name] = {**metrics, 'linear_weight_mb': linear_weight_mb(model), 'ms_per_token': ms_per_token, 'llm_rtf': rtf}
+    print('{} of {} units quantized, {} threads'.format(len(selected), len(units), torch.get_num_threads()))
+    print('{:>8} {:>12} {:>8} {:>12} {:>8} {:>10} {:>8}'.format('model', 'linear MB', 'acc', 'top1 agree', 'kl', 'ms/token', 'rtf'))
+    for name, metrics in report.items():
+        print('{:>8} {:>12.1f} {:>8.4f} {:>12.4f} {:>8.4f} {:>10.2f} {:>8.4f}'.format(
+            name, metrics['linear_weight_mb'], metrics['acc'], metrics['top1_agreement'], metrics['kl'], metrics['ms_per_token'], metrics['llm_rtf']))
+
+    output = args.output if args.output is not None else '{}/llm.int8.json'.format(args.model_dir)
+    with open(output, 'w', encoding='utf8') as f:
+        json.dump({'units': selected, 'max_kl': args.max_kl, 'calibration_utts': [batch['utt'] for batch in batches],
+                   'sensitivity': sensitivity, 'report': report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,17 +13,32 @@
 # limitations under the License.
 import os
 import time
+import torch
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
 from modelscope import snapshot_download
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel
+from cosyvoice.utils.common import set_cpu_threads
 from cosyvoice.utils.file_utils import logging
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True):
+    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True, llm_max_batch_size=1,
+                 onnx_intra_op_num_threads=1, onnx_providers=None, prompt_cache_size_mb=256, prompt_cache_dir=None,
+                 voice_dir=None, load_onnx_hift=False, bf16=False, quantize=False, num_threads=None, num_interop_threads=0,
+                 num_workers=1, load_int8_llm=False):
+        """
+        Args for cpu inference, fp16 is turned off without a cuda device:
+            bf16 (bool): run the llm in bfloat16, faster on cpus with avx512_bf16 or amx.
+            quantize (bool): convert the Linear layers of the torch llm and flow to dynamic int8, fp32 only.
+            load_int8_llm (bool): convert the llm units calibrated by cosyvoice/bin/quantize_llm.py to dynamic int8, fp32 only.
+            num_threads (int): torch threads of this process, 0 splits the cores among num_workers worker processes,
+                None keeps the torch defaults, see set_cpu_threads.
+        load_jit loads the llm jit models of the llm dtype, see cosyvoice/bin/export_jit.py --dtype,
+        and is skipped with a warning if they are not exported.
+        """
         instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         if not os.path.exists(model_dir):
@@ -36,77 +51,136 @@ class CosyVoice:
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
                                           instruct,
-                                          configs['allowed_special'])
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+                                          configs['allowed_special'],
+                                          prompt_cache_size_mb=prompt_cache_size_mb,
+                                          prompt_cache_dir=prompt_cache_dir)
+        # voices enrolled by add_voice are persisted in voice_dir and loaded at start
+        self.voice_dir = voice_dir
+        if self.voice_dir is not None:
+            self.frontend.load_voices(self.voice_dir)
+        if fp16 is True and torch.cuda.is_available() is False:
+            logging.warning('no cuda device, set fp16 to False')
+            fp16 = False
+        if num_threads is not None:
+            num_threads = set_cpu_threads(num_threads, num_interop_threads, num_workers)
+            logging.info('use {} torch threads'.format(num_threads))
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16, bf16=bf16)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        llm_dtype = 'fp16' if fp16 is True else 'bf16' if bf16 is True else 'fp32'
+        if load_jit and not os.path.exists('{}/llm.llm.{}.zip'.format(model_dir, llm_dtype)):
+            logging.warning('no {} jit model, export it by export_jit.py --dtype {}, set load_jit to False'.format(llm_dtype, llm_dtype))
+            load_jit = False
         if load_jit:
-            self.model.load_jit('{}/llm.text_encoder.fp16.zip'.format(model_dir),
-                                '{}/llm.llm.fp16.zip'.format(model_dir),
+            self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, llm_dtype),
+                                '{}/llm.llm.{}.zip'.format(model_dir, llm_dtype),
                                 '{}/flow.encoder.fp32.zip'.format(model_dir))
         if load_onnx:
-            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir))
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                 intra_op_num_threads=onnx_intra_op_num_threads,
+                                 providers=onnx_providers)
+        if load_onnx_hift:
+            self.model.load_onnx_hift('{}/hift.fp32.onnx'.format(model_dir),
+                                      intra_op_num_threads=onnx_intra_op_num_threads,
+                                      providers=onnx_providers)
+        if quantize:
+            self.model.quantize_dynamic()
+        if load_int8_llm:
+            self.model.load_int8_llm('{}/llm.int8.json'.format(model_dir))
+        if llm_max_batch_size > 1:
+            self.model.load_scheduler(llm_max_batch_size)
         del configs
 
+    def close(self):
+        """Shut down the text normalization worker processes, see CosyVoiceFrontEnd.text_normalize_batch."""
+        self.frontend.close()
+
     def list_avaliable_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
+    def split_tts_text(self, tts_text):
+        """Normalize and split tts_text, which is either a str or an iterator of str fragments,
+        e.g. a transformers TextIteratorStreamer, whose segments are synthesized while later fragments are still generated."""
+        if isinstance(tts_text, str):
+            return tqdm(self.frontend.text_normalize(tts_text, split=True))
+        return self.frontend.text_normalize_stream(tts_text)
+
+    def inference_segments(self, tts_text, frontend_fn, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None,
+                           pipeline=False):
+        """Synthesize the segments of tts_text one by one, frontend_fn maps a segment to the model input.
+
+        With pipeline=True the llm of the next segment decodes while flow and hift of the current one run,
+        see CosyVoiceModel.tts_pipeline. It is meant for text known in advance, with a text iterator it is turned off,
+        as reading the next segment ahead would delay the audio of the current one until the iterator yields it.
+        """
+        if pipeline is True and not isinstance(tts_text, str):
+            logging.warning('pipeline only supports str tts_text, synthesize the segments of the text iterator one by one')
+            pipeline = False
+
+        def model_inputs():
+            for i in self.split_tts_text(tts_text):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                logging.info('synthesis text {}'.format(i))
+                yield frontend_fn(i)
+        if pipeline is True:
+            model_outputs = self.model.tts_pipeline(model_inputs(), stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                                    cancel_event=cancel_event)
+        else:
+            model_outputs = (model_output for model_input in model_inputs()
+                             for model_output in self.model.tts(**model_input, stream=stream, speed=speed, quality=quality,
+                                                                n_timesteps=n_timesteps, cancel_event=cancel_event))
+        start_time = time.time()
+        for model_output in model_outputs:
+            speech_len = model_output['tts_speech'].shape[1] / 22050
+            logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+            yield model_output
             start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, stream=False, speed=1.0):
+
+    def add_voice(self, voice_id, prompt_text, prompt_speech_16k):
+        """Enroll a zero-shot prompt, inference_sft(tts_text, voice_id) then reuses its tokens, feats and embedding."""
         prompt_text = self.frontend.text_normalize(prompt_text, split=False)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0):
+        self.frontend.add_voice(voice_id, prompt_text, prompt_speech_16k, voice_dir=self.voice_dir)
+
+    def remove_voice(self, voice_id):
+        self.frontend.remove_voice(voice_id, voice_dir=self.voice_dir)
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None, pipeline=False):
+        yield from self.inference_segments(tts_text, lambda i: self.frontend.frontend_sft(i, spk_id),
+                                           stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                           cancel_event=cancel_event, pipeline=pipeline)
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k,
+                            stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None, pipeline=False):
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False)
+        yield from self.inference_segments(tts_text, lambda i: self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k),
+                                           stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                           cancel_event=cancel_event, pipeline=pipeline)
+
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None,
+                                pipeline=False):
         if self.frontend.instruct is True:
             raise ValueError('{} do not support cross_lingual inference'.format(self.model_dir))
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0):
+        yield from self.inference_segments(tts_text, lambda i: self.frontend.frontend_cross_lingual(i, prompt_speech_16k),
+                                           stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                           cancel_event=cancel_event, pipeline=pipeline)
+
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None,
+                           pipeline=False):
         if self.frontend.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / 22050
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+        yield from self.inference_segments(tts_text, lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text),
+                                           stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                           cancel_event=cancel_event, pipeline=pipeline)
+
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k)
         start_time = time.time()
-        for model_output in self.model.vc(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.vc(**model_input, stream=stream, speed=speed, quality=quality, n_timesteps=n_timesteps,
+                                          cancel_event=cancel_event):
             speech_len = model_output['tts_speech'].shape[1] / 22050
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -11,17 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from functools import partial
 import onnxruntime
 import torch
-import numpy as np
-import whisper
-from typing import Callable
-import torchaudio.compliance.kaldi as kaldi
-import torchaudio
+from typing import Callable, Generator, Iterable, List, Optional, Tuple
 import os
 import re
+import threading
 import inflect
+import multiprocessing
 try:
     import ttsfrd
     use_ttsfrd = True
@@ -30,7 +30,37 @@ except ImportError:
     from tn.chinese.normalizer import Normalizer as ZhNormalizer
     from tn.english.normalizer import Normalizer as EnNormalizer
     use_ttsfrd = False
-from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph
+from cosyvoice.cli.prompt_cache import PromptCache
+from cosyvoice.utils.audio_utils import resample
+from cosyvoice.utils.embedding_utils import compute_campplus_fbank, extract_spk_embedding
+from cosyvoice.utils.speech_token_utils import extract_speech_token
+from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, \
+    split_paragraph_stream
+
+
+def _normalize_text(text: str, zh_normalize: Callable[[str], str], en_normalize: Callable[[str], str], inflect_parser,
+                    tokenizer, allowed_special) -> Tuple[str, Tuple[str, ...]]:
+    """Normalize text by the normalizer of its language, returns the normalized text and its segments.
+
+    Shared by CosyVoiceFrontEnd and the worker processes of text_normalize_batch, which pass their own normalizers.
+    """
+    if contains_chinese(text):
+        text = zh_normalize(text)
+        text = text.replace("\n", "")
+        text = replace_blank(text)
+        text = replace_corner_mark(text)
+        text = text.replace(".", "。")
+        text = text.replace(" - ", "，")
+        text = remove_bracket(text)
+        text = re.sub(r'[，,、]+$', '。', text)
+        texts = list(split_paragraph(text, partial(tokenizer.encode, allowed_special=allowed_special), "zh", token_max_n=80,
+                                     token_min_n=60, merge_len=20, comma_split=False))
+    else:
+        text = en_normalize(text)
+        text = spell_out_number(text, inflect_parser)
+        texts = list(split_paragraph(text, partial(tokenizer.encode, allowed_special=allowed_special), "en", token_max_n=80,
+                                     token_min_n=60, merge_len=20, comma_split=False))
+    return text, tuple(texts)
 
 
 class CosyVoiceFrontEnd:
@@ -42,7 +72,10 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  instruct: bool = False,
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_size_mb: float = 256,
+                 prompt_cache_dir: Optional[str] = None,
+                 text_normalize_cache_size: int = 4096):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -58,7 +91,18 @@ class CosyVoiceFrontEnd:
         else:
             self.spk2info = {}
         self.instruct = instruct
+        # prompt features of reused reference voices are extracted only once
+        if prompt_cache_size_mb > 0 or prompt_cache_dir is not None:
+            self.prompt_cache = PromptCache(prompt_cache_size_mb, prompt_cache_dir, device=self.device)
+        else:
+            self.prompt_cache = None
         self.allowed_special = allowed_special
+        # normalization results are memoized by input text in lru order, repeated phrases are normalized once
+        self.text_normalize_cache_size = text_normalize_cache_size
+        self.normalize_cache: OrderedDict = OrderedDict()
+        self.normalize_lock = threading.Lock()
+        # worker processes of text_normalize_batch, created on first use and kept until close
+        self.normalize_pool, self.normalize_pool_workers = None, 0
         self.inflect_parser = inflect.engine()
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
@@ -80,25 +124,17 @@ class CosyVoiceFrontEnd:
         return text_token, text_token_len
 
     def _extract_speech_token(self, speech):
-        assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
-        feat = whisper.log_mel_spectrogram(speech, n_mels=128)
-        speech_token = self.speech_tokenizer_session.run(None,
-                                                         {self.speech_tokenizer_session.get_inputs()[0].name:
-                                                          feat.detach().cpu().numpy(),
-                                                          self.speech_tokenizer_session.get_inputs()[1].name:
-                                                          np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
+        speech = speech.to(self.device)
+        # audio longer than 30s is tokenized in overlapping windows
+        speech_token = extract_speech_token(self.speech_tokenizer_session, speech)
         speech_token = torch.tensor([speech_token], dtype=torch.int32).to(self.device)
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
     def _extract_spk_embedding(self, speech):
-        feat = kaldi.fbank(speech,
-                           num_mel_bins=80,
-                           dither=0,
-                           sample_frequency=16000)
-        feat = feat - feat.mean(dim=0, keepdim=True)
-        embedding = self.campplus_session.run(None,
-                                              {self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
+        speech = speech.to(self.device)
+        feat = compute_campplus_fbank(speech)
+        embedding = extract_spk_embedding(self.campplus_session, [feat]).flatten().tolist()
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
@@ -108,53 +144,164 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
-    def text_normalize(self, text, split=True):
-        text = text.strip()
-        if contains_chinese(text):
-            if self.use_ttsfrd:
-                text = self.frd.get_frd_extra_info(text, 'input')
-            else:
-                text = self.zh_tn_model.normalize(text)
-            text = text.replace("\n", "")
-            text = replace_blank(text)
-            text = replace_corner_mark(text)
-            text = text.replace(".", "。")
-            text = text.replace(" - ", "，")
-            text = remove_bracket(text)
-            text = re.sub(r'[，,、]+$', '。', text)
-            texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
-                                         token_min_n=60, merge_len=20, comma_split=False))
+    def _extract_prompt(self, prompt_text, prompt_speech_16k):
+        def extract():
+            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+            # all spectral features are computed on device, their windows and mel bases are cached there
+            prompt_speech_22050 = resample(prompt_speech_16k.to(self.device), 16000, 22050)
+            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
+            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+            embedding = self._extract_spk_embedding(prompt_speech_16k)
+            return {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                    'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                    'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                    'embedding': embedding}
+        if self.prompt_cache is None:
+            return extract()
+        return self.prompt_cache.get_or_compute(prompt_speech_16k, prompt_text, extract)
+
+    def _normalize_uncached(self, text):
+        if self.use_ttsfrd:
+            zh_normalize = en_normalize = lambda text: self.frd.get_frd_extra_info(text, 'input')
         else:
-            if self.use_ttsfrd:
-                text = self.frd.get_frd_extra_info(text, 'input')
-            else:
-                text = self.en_tn_model.normalize(text)
-            text = spell_out_number(text, self.inflect_parser)
-            texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
-                                         token_min_n=60, merge_len=20, comma_split=False))
+            zh_normalize, en_normalize = self.zh_tn_model.normalize, self.en_tn_model.normalize
+        return _normalize_text(text, zh_normalize, en_normalize, self.inflect_parser, self.tokenizer, self.allowed_special)
+
+    def _normalize(self, text):
+        with self.normalize_lock:
+            result = self.normalize_cache.get(text)
+            if result is not None:
+                self.normalize_cache.move_to_end(text)
+                return result
+        result = self._normalize_uncached(text)
+        self._cache_normalized(text, result)
+        return result
+
+    def _cache_normalized(self, text, result):
+        if self.text_normalize_cache_size <= 0:
+            return
+        with self.normalize_lock:
+            self.normalize_cache[text] = result
+            self.normalize_cache.move_to_end(text)
+            while len(self.normalize_cache) > self.text_normalize_cache_size:
+                self.normalize_cache.popitem(last=False)
+
+    def text_normalize(self, text, split=True):
+        text, texts = self._normalize(text.strip())
         if split is False:
             return text
-        return texts
+        return list(texts)
+
+    def text_normalize_stream(self, fragments: Iterable[str]) -> Generator[str, None, None]:
+        """Normalize and split text which arrives in fragments, e.g. from a llm streamer.
+
+        Each segment is yielded as soon as it is complete, see split_paragraph_stream.
+        """
+        for segment in split_paragraph_stream(fragments, partial(self.tokenizer.encode, allowed_special=self.allowed_special),
+                                              token_max_n=80, token_min_n=60, merge_len=20):
+            for text in self.text_normalize(segment, split=True):
+                yield text
+
+    def _get_normalize_pool(self, num_workers):
+        with self.normalize_lock:
+            if self.normalize_pool is not None and self.normalize_pool_workers != num_workers:
+                self.normalize_pool.shutdown()
+                self.normalize_pool = None
+            if self.normalize_pool is None:
+                # spawn, a forked copy of this process would inherit the torch and onnxruntime thread pools
+                self.normalize_pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                          initializer=_init_normalize_worker, initargs=(self.tokenizer, self.allowed_special))
+                self.normalize_pool_workers = num_workers
+            return self.normalize_pool
+
+    def text_normalize_batch(self, texts: List[str], split=True, num_workers=4):
+        """Normalize many texts, distinct texts which are not cached yet are normalized by num_workers processes.
+
+        Normalization is cpu bound python, so it runs in processes rather than threads. The worker processes load
+        their own WeTextProcessing normalizers once and are kept for later calls until close. Their results go to
+        the text_normalize cache.
+        """
+        results = {}
+        for text in dict.fromkeys(text.strip() for text in texts):
+            with self.normalize_lock:
+                results[text] = self.normalize_cache.get(text)
+                if results[text] is not None:
+                    self.normalize_cache.move_to_end(text)
+        uncached_texts = [text for text, result in results.items() if result is None]
+        # ttsfrd engine is initialized from a resource dir, it is only run in this process
+        if num_workers > 1 and self.use_ttsfrd is False and len(uncached_texts) > 1:
+            pool = self._get_normalize_pool(num_workers)
+            chunksize = max(1, len(uncached_texts) // (num_workers * 4))
+            for text, result in zip(uncached_texts, pool.map(_normalize_in_worker, uncached_texts, chunksize=chunksize)):
+                self._cache_normalized(text, result)
+                results[text] = result
+        else:
+            for text in uncached_texts:
+                results[text] = self._normalize(text)
+        if split is False:
+            return [results[text.strip()][0] for text in texts]
+        return [list(results[text.strip()][1]) for text in texts]
+
+    def close(self):
+        """Shut down the worker processes of text_normalize_batch."""
+        with self.normalize_lock:
+            if self.normalize_pool is not None:
+                self.normalize_pool.shutdown()
+                self.normalize_pool, self.normalize_pool_workers = None, 0
+
+    def add_voice(self, voice_id, prompt_text, prompt_speech_16k, voice_dir=None):
+        """Enroll a zero-shot prompt as voice_id, frontend_sft(tts_text, voice_id) then uses the prompt without extracting it again.
+
+        If voice_dir is given, the voice is also saved to voice_dir/<voice_id>.pt, see load_voices.
+        """
+        if re.fullmatch(r'[\w\-.]+', voice_id) is None or voice_id.startswith('.'):
+            raise ValueError('invalid voice id {}, use letters, digits, "_", "-" and "."'.format(voice_id))
+        prompt = self._extract_prompt(prompt_text, prompt_speech_16k)
+        # voices are kept on cpu like the tensors loaded by load_voices, tts moves them to its device
+        voice = {k: v.cpu() for k, v in prompt.items()}
+        if voice_dir is not None:
+            os.makedirs(voice_dir, exist_ok=True)
+            path = os.path.join(voice_dir, '{}.pt'.format(voice_id))
+            torch.save(voice, '{}.tmp'.format(path))
+            os.replace('{}.tmp'.format(path), path)
+        self.spk2info[voice_id] = voice
+        return voice
+
+    def remove_voice(self, voice_id, voice_dir=None):
+        self.spk2info.pop(voice_id)
+        if voice_dir is not None and os.path.exists(os.path.join(voice_dir, '{}.pt'.format(voice_id))):
+            os.remove(os.path.join(voice_dir, '{}.pt'.format(voice_id)))
+
+    def load_voices(self, voice_dir):
+        """Load all voices saved by add_voice, the files are memory mapped instead of being read into memory."""
+        if not os.path.isdir(voice_dir):
+            return
+        for name in sorted(os.listdir(voice_dir)):
+            if name.endswith('.pt'):
+                self.spk2info[name[:-len('.pt')]] = torch.load(os.path.join(voice_dir, name), map_location='cpu', mmap=True, weights_only=True)
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        embedding = self.spk2info[spk_id]['embedding']
+        voice = self.spk2info[spk_id]
+        embedding = voice['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        # voices enrolled by add_voice also carry their prompt, which gives zero-shot quality
+        if 'speech_token' in voice:
+            model_input.update({'prompt_text': voice['prompt_text'], 'prompt_text_len': voice['prompt_text_len'],
+                                'llm_prompt_speech_token': voice['speech_token'], 'llm_prompt_speech_token_len': voice['speech_token_len'],
+                                'flow_prompt_speech_token': voice['speech_token'], 'flow_prompt_speech_token_len': voice['speech_token_len'],
+                                'prompt_speech_feat': voice['speech_feat'], 'prompt_speech_feat_len': voice['speech_feat_len']})
         return model_input
 
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = self._extract_prompt(prompt_text, prompt_speech_16k)
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
-                       'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                       'llm_embedding': embedding, 'flow_embedding': embedding}
+                       'prompt_text': prompt['prompt_text'], 'prompt_text_len': prompt['prompt_text_len'],
+                       'llm_prompt_speech_token': prompt['speech_token'], 'llm_prompt_speech_token_len': prompt['speech_token_len'],
+                       'flow_prompt_speech_token': prompt['speech_token'], 'flow_prompt_speech_token_len': prompt['speech_token_len'],
+                       'prompt_speech_feat': prompt['speech_feat'], 'prompt_speech_feat_len': prompt['speech_feat_len'],
+                       'llm_embedding': prompt['embedding'], 'flow_embedding': prompt['embedding']}
         return model_input
 
     def frontend_cross_lingual(self, tts_text, prompt_speech_16k):
@@ -170,19 +317,36 @@ class CosyVoiceFrontEnd:
         model_input = self.frontend_sft(tts_text, spk_id)
         # in instruct mode, we remove spk_embedding in llm due to information leakage
         del model_input['llm_embedding']
+        # the llm prompt of enrolled voices is replaced by the instruct text, flow still uses the prompt
+        model_input.pop('llm_prompt_speech_token', None)
+        model_input.pop('llm_prompt_speech_token_len', None)
         instruct_text_token, instruct_text_token_len = self._extract_text_token(instruct_text + '<endofprompt>')
         model_input['prompt_text'] = instruct_text_token
         model_input['prompt_text_len'] = instruct_text_token_len
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = self._extract_prompt('', prompt_speech_16k)
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
-                       'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
-                       'prompt_speech_feat': prompt_speech_feat, 'prompt_speech_feat_len': prompt_speech_feat_len,
-                       'flow_embedding': embedding}
+                       'flow_prompt_speech_token': prompt['speech_token'], 'flow_prompt_speech_token_len': prompt['speech_token_len'],
+                       'prompt_speech_feat': prompt['speech_feat'], 'prompt_speech_feat_len': prompt['speech_feat_len'],
+                       'flow_embedding': prompt['embedding']}
         return model_input
+
+
+# normalizers of a worker process of text_normalize_batch, built once by _init_normalize_worker
+_normalize_worker = None
+
+
+def _init_normalize_worker(tokenizer, allowed_special):
+    global _normalize_worker
+    _normalize_worker = {'zh_normalize': ZhNormalizer(remove_erhua=False, full_to_half=False).normalize,
+                         'en_normalize': EnNormalizer().normalize,
+                         'inflect_parser': inflect.engine(),
+                         'tokenizer': tokenizer,
+                         'allowed_special': allowed_special}
+
+
+def _normalize_in_worker(text):
+    return _normalize_text(text, **_normalize_worker)
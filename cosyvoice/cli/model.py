@@ -11,14 +11,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import torch
-import numpy as np
 import threading
-import time
 from torch.nn import functional as F
+from collections import deque
 from contextlib import nullcontext
-import uuid
-from cosyvoice.utils.common import fade_in_out
+from cosyvoice.cli.session import SessionPool, TTSSession
+from cosyvoice.hifigan.streaming import HiFTStreamer
+from cosyvoice.utils.common import crossfade
+from cosyvoice.flow.flow_matching import FLOW_QUALITY_TIERS
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.llm.scheduler import ContinuousBatchScheduler
+from cosyvoice.utils.quantize_utils import quantize_linear_dynamic
 
 
 class CosyVoiceModel:
@@ -27,40 +32,44 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool):
+                 fp16: bool,
+                 max_sessions: int = 64,
+                 stateful_hift: bool = True,
+                 bf16: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # llm weights and activations dtype, bf16 is meant for cpus with avx512_bf16 or amx, fp16 for gpus
+        self.llm_dtype = torch.float16 if fp16 is True else torch.bfloat16 if bf16 is True else torch.float32
         self.token_min_hop_len = 2 * self.flow.input_frame_rate
         self.token_max_hop_len = 4 * self.flow.input_frame_rate
         self.token_overlap_len = 20
-        # mel fade in out
+        # mel fade in out, see crossfade
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
-        # hift cache
+        # streaming vocodes chunks with HiFTStreamer, which carries the state of every hift layer over chunks,
+        # stateful_hift=False re-runs hift on mel_cache_len cached frames and crossfades the overlapping speech instead
+        self.stateful_hift = stateful_hift
+        # hift cache, the speech tail of a chunk is crossfaded with the head of the next one
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        # onnxruntime hift session, see load_onnx_hift
+        self.hift_onnx = None
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # continuous batching scheduler shared by all llm_job threads, see load_scheduler
+        self.llm_scheduler = None
+        # session related variables, released sessions are cleared so memory stays flat
+        self.session_pool = SessionPool(max_sessions=max_sessions)
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=False)
         self.llm.to(self.device).eval()
-        if self.fp16 is True:
-            self.llm.half()
+        if self.llm_dtype != torch.float32:
+            self.llm.to(self.llm_dtype)
         self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=False)
         self.flow.to(self.device).eval()
         # in case hift_model is a hifigan model
@@ -69,7 +78,7 @@ class CosyVoiceModel:
         self.hift.to(self.device).eval()
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
-        assert self.fp16 is True, "we only provide fp16 jit model, set fp16=True if you want to use jit model"
+        """Load jit models exported by cosyvoice/bin/export_jit.py, the llm ones must be exported in llm_dtype."""
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
         llm_llm = torch.jit.load(llm_llm_model, map_location=self.device)
@@ -77,180 +86,354 @@ class CosyVoiceModel:
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
-    def load_onnx(self, flow_decoder_estimator_model):
+    def _onnx_session(self, model, intra_op_num_threads, inter_op_num_threads, providers):
         import onnxruntime
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
-        providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
+        option.intra_op_num_threads = intra_op_num_threads
+        option.inter_op_num_threads = inter_op_num_threads
+        if providers is None:
+            providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
+        return onnxruntime.InferenceSession(model, sess_options=option, providers=providers)
+
+    def load_onnx(self, flow_decoder_estimator_model, intra_op_num_threads=1, inter_op_num_threads=0, providers=None):
+        """Load the onnx flow decoder estimator.
+
+        Args:
+            intra_op_num_threads (int): threads used inside an op, 0 means onnxruntime default.
+            inter_op_num_threads (int): threads used across ops, 0 means onnxruntime default.
+            providers (list): onnxruntime providers, names or (name, provider options) tuples,
+                e.g. [('CUDAExecutionProvider', {'device_id': 0})], defaults to cuda if available else cpu.
+        """
         del self.flow.decoder.estimator
-        self.flow.decoder.estimator = onnxruntime.InferenceSession(flow_decoder_estimator_model, sess_options=option, providers=providers)
+        self.flow.decoder.estimator = self._onnx_session(flow_decoder_estimator_model, intra_op_num_threads, inter_op_num_threads, providers)
+
+    def load_onnx_hift(self, hift_model, intra_op_num_threads=1, inter_op_num_threads=0, providers=None):
+        """Load the onnx hift exported by cosyvoice/bin/export_onnx.py, arguments are the same as load_onnx.
+
+        The torch hift is kept to draw the random values of the source. Streaming
+        with the onnx hift uses the cached mel and source path, the stateful
+        HiFTStreamer runs on the torch hift only.
+        """
+        self.hift_onnx = self._onnx_session(hift_model, intra_op_num_threads, inter_op_num_threads, providers)
+
+    def hift_inference(self, speech_feat, cache_source=torch.zeros(1, 1, 0)):
+        """Vocode speech_feat with the onnx hift if loaded, else with the torch hift, returns speech and source."""
+        if self.hift_onnx is None:
+            return self.hift.inference(speech_feat=speech_feat, cache_source=cache_source)
+        source_len = speech_feat.shape[2] * int(self.hift.f0_upsamp.scale_factor)
+        phase_vec, noise = self.hift.m_source.l_sin_gen.sample_random(speech_feat.shape[0], source_len, 'cpu')
+        ort_inputs = {
+            'speech_feat': speech_feat.float().cpu().numpy(),
+            'cache_source': cache_source.float().cpu().numpy(),
+            'phase_vec': phase_vec.numpy(),
+            'noise': noise.numpy()
+        }
+        tts_speech, tts_source = self.hift_onnx.run(None, ort_inputs)
+        return torch.from_numpy(tts_speech).to(self.device), torch.from_numpy(tts_source).to(self.device)
+
+    def quantize_dynamic(self):
+        """Quantize the Linear layers of the torch llm and flow to dynamic int8, for fp32 models on cpu.
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        if self.fp16 is True:
-            llm_embedding = llm_embedding.half()
-        with self.llm_context:
-            for i in self.llm.inference(text=text.to(self.device),
-                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_text=prompt_text.to(self.device),
-                                        prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                        prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                        embedding=llm_embedding.to(self.device)):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        Jit and onnx models loaded before are kept as they are, so call it after
+        load and only load the jit or onnx models meant to stay in float.
+        """
+        assert self.device.type == 'cpu' and self.llm_dtype == torch.float32, 'dynamic int8 quantization needs fp32 models on cpu'
+        names = quantize_linear_dynamic(self.llm, ['text_encoder', 'llm', 'llm_decoder'])
+        names += ['flow.' + name for name in quantize_linear_dynamic(self.flow, ['encoder', 'encoder_proj', 'decoder.estimator'])]
+        logging.info('quantize linear layers of {} to dynamic int8'.format(names))
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        tts_mel, flow_cache = self.flow.inference(token=token.to(self.device),
-                                                  token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                  prompt_token=prompt_token.to(self.device),
-                                                  prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                  prompt_feat=prompt_feat.to(self.device),
-                                                  prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                  embedding=embedding.to(self.device),
-                                                  flow_cache=self.flow_cache_dict[uuid])
-        self.flow_cache_dict[uuid] = flow_cache
+    def load_int8_llm(self, llm_int8_config):
+        """Quantize the llm units selected by cosyvoice/bin/quantize_llm.py to dynamic int8, for fp32 models on cpu."""
+        assert self.device.type == 'cpu' and self.llm_dtype == torch.float32, 'dynamic int8 quantization needs fp32 models on cpu'
+        with open(llm_int8_config, 'r', encoding='utf8') as f:
+            units = json.load(f)['units']
+        names = quantize_linear_dynamic(self.llm, units)
+        logging.info('quantize {} of {} llm units to dynamic int8'.format(len(names), len(units)))
+
+    def load_scheduler(self, max_batch_size):
+        if isinstance(self.llm.llm, torch.jit.ScriptModule):
+            logging.warning('continuous batching requires batched forward_chunk, re-export llm.llm jit model if it was exported before')
+        self.llm_scheduler = ContinuousBatchScheduler(self.llm, max_batch_size=max_batch_size, llm_context=self.llm_context)
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session: TTSSession, cancel_event=None, prev_llm_thread=None):
+        llm_embedding = llm_embedding.to(self.llm_dtype)
+        llm = self.llm_scheduler if self.llm_scheduler is not None else self.llm
+        token_cond = session.token_cond
+        try:
+            # pipelined segments decode one after another, so that they do not compete for the llm
+            if prev_llm_thread is not None:
+                prev_llm_thread.join()
+                if session.cancelled:
+                    return
+            with self.llm_context:
+                for i in llm.inference(text=text.to(self.device),
+                                       text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                       prompt_text=prompt_text.to(self.device),
+                                       prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                       prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                       prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                       embedding=llm_embedding.to(self.device),
+                                       cancel_event=cancel_event):
+                    # session is released, e.g. the tts generator is closed, stop decoding
+                    if session.cancelled:
+                        break
+                    with token_cond:
+                        session.speech_tokens.append(i)
+                        token_cond.notify()
+        except Exception as e:
+            # re-raised by tts in the caller thread
+            session.llm_error = e
+        finally:
+            # also wake up token2wav when llm fails, otherwise it waits forever
+            with token_cond:
+                session.llm_end = True
+                token_cond.notify()
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session: TTSSession, finalize=False, speed=1.0, n_timesteps=10, solver=None):
+        tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device),
+                                                          token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_token=prompt_token.to(self.device),
+                                                          prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_feat=prompt_feat.to(self.device),
+                                                          prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                          embedding=embedding.to(self.device),
+                                                          flow_cache=session.flow_cache,
+                                                          n_timesteps=n_timesteps,
+                                                          solver=solver)
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = crossfade(tts_mel, session.mel_overlap, self.mel_overlap_len)
+        if self.stateful_hift is True and self.hift_onnx is None and (finalize is False or session.hift_stream is not None):
+            if finalize is False:
+                session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
+                tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
+            else:
+                assert speed == 1.0, 'speed change only support non-stream inference mode'
+            if session.hift_stream is None:
+                session.hift_stream = HiFTStreamer(self.hift)
+            return session.hift_stream(tts_mel, final=finalize)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            tts_speech, tts_source = self.hift_inference(tts_mel, hift_cache_source)
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            tts_speech, tts_source = self.hift_inference(tts_mel, hift_cache_source)
+            if session.hift_cache is not None:
+                tts_speech = crossfade(tts_speech, session.hift_cache['speech'], self.source_cache_len)
         return tts_speech
 
+    def flow_solver(self, quality='high', n_timesteps=None):
+        """Resolve the ode solver and number of timesteps of flow decoding from a quality tier,
+        n_timesteps overrides the number of timesteps of the tier."""
+        if quality not in FLOW_QUALITY_TIERS:
+            raise ValueError('unsupported quality {}, choose from {}'.format(quality, list(FLOW_QUALITY_TIERS.keys())))
+        solver, tier_n_timesteps = FLOW_QUALITY_TIERS[quality]
+        return solver, tier_n_timesteps if n_timesteps is None else n_timesteps
+
     def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, quality='high', n_timesteps=None,
+            cancel_event=None, **kwargs):
+        """Synthesize speech of text, stop early once cancel_event (threading.Event) is set, e.g. by a client disconnect."""
+        solver, n_timesteps = self.flow_solver(quality, n_timesteps)
+        # the session is released when this generator finishes or is closed early,
+        # which cancels and joins llm_job and drops all cached tensors
+        with self.session_pool.session() as session:
+            self.start_llm_job(session, text, prompt_text, llm_prompt_speech_token, llm_embedding, cancel_event=cancel_event)
+            yield from self.session_token2wav(session, flow_embedding, flow_prompt_speech_token, prompt_speech_feat,
+                                              stream=stream, speed=speed, solver=solver, n_timesteps=n_timesteps, cancel_event=cancel_event)
+
+    def tts_pipeline(self, model_inputs, stream=False, speed=1.0, quality='high', n_timesteps=None, cancel_event=None):
+        """Synthesize consecutive segments, model_inputs is an iterable of tts kwargs, e.g. frontend outputs.
+
+        The llm of segment k + 1 starts decoding in llm_context as soon as the llm of segment k ends,
+        while flow and hift of segment k still run, audio is yielded in segment order. The session of
+        segment k + 1 is only taken if one is free right away, a request never waits for a second session
+        while it holds one, otherwise segment k + 1 runs after segment k released its session.
+        model_inputs is read ahead by one segment, so it should not block, e.g. on a text iterator.
+        """
+        solver, n_timesteps = self.flow_solver(quality, n_timesteps)
+        model_inputs = iter(model_inputs)
+        # (session context, session, model_input) of started segments, at most the current and the next one
+        pending = deque()
+        # the next model_input, read but not started because no session was free
+        deferred = []
+
+        def start_next(wait):
+            model_input = deferred.pop() if len(deferred) != 0 else next(model_inputs, None)
+            if model_input is None or (cancel_event is not None and cancel_event.is_set()):
+                return
+            session_context = self.session_pool.session(timeout=None if wait else 0)
+            try:
+                session = session_context.__enter__()
+            except RuntimeError:
+                deferred.append(model_input)
+                return
+            pending.append((session_context, session, model_input))
+            self.start_llm_job(session, model_input['text'], model_input.get('prompt_text', torch.zeros(1, 0, dtype=torch.int32)),
+                               model_input.get('llm_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                               model_input.get('llm_embedding', torch.zeros(0, 192)), cancel_event=cancel_event,
+                               prev_llm_thread=pending[-2][1].llm_thread if len(pending) > 1 else None)
 
-    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = source_speech_token.flatten().tolist(), True
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+        try:
+            start_next(wait=True)
+            while len(pending) != 0:
+                session_context, session, model_input = pending[0]
+                start_next(wait=False)
+                yield from self.session_token2wav(session, model_input['flow_embedding'],
+                                                  model_input.get('flow_prompt_speech_token', torch.zeros(1, 0, dtype=torch.int32)),
+                                                  model_input.get('prompt_speech_feat', torch.zeros(1, 0, 80)),
+                                                  stream=stream, speed=speed, solver=solver, n_timesteps=n_timesteps, cancel_event=cancel_event)
+                pending.popleft()
+                session_context.__exit__(None, None, None)
+                if len(pending) == 0:
+                    # no session was free for the next segment, wait for one now that this request holds none
+                    start_next(wait=True)
+        finally:
+            # generator closed early or failed, cancel the prefetched session before it starts decoding and release all
+            for _, session, _ in pending:
+                session.cancel()
+            while len(pending) != 0:
+                pending.popleft()[0].__exit__(None, None, None)
+
+    def start_llm_job(self, session: TTSSession, text, prompt_text, llm_prompt_speech_token, llm_embedding, cancel_event=None,
+                      prev_llm_thread=None):
+        session.llm_thread = threading.Thread(target=self.llm_job,
+                                              args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session, cancel_event,
+                                                    prev_llm_thread))
+        session.llm_thread.start()
+
+    def session_token2wav(self, session: TTSSession, flow_embedding, flow_prompt_speech_token, prompt_speech_feat, stream=False, speed=1.0,
+                          solver=None, n_timesteps=10, cancel_event=None):
+        """Convert the speech tokens of session to speech as they are decoded by its llm_job."""
+        token_cond = session.token_cond
         if stream is True:
             token_hop_len = self.token_min_hop_len
             while True:
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+                # wake up as soon as a full chunk of tokens is available or llm ends
+                with token_cond:
+                    token_cond.wait_for(lambda: len(session.speech_tokens) >= token_hop_len + self.token_overlap_len or session.llm_end is True)
+                if session.llm_error is not None or (cancel_event is not None and cancel_event.is_set()):
+                    break
+                if len(session.speech_tokens) >= token_hop_len + self.token_overlap_len:
+                    this_tts_speech_token = torch.tensor(session.speech_tokens[:token_hop_len + self.token_overlap_len]).unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
+                                                     session=session,
+                                                     finalize=False,
+                                                     n_timesteps=n_timesteps,
+                                                     solver=solver)
                     yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                    with token_cond:
+                        session.speech_tokens = session.speech_tokens[token_hop_len:]
                     # increase token_hop_len for better speech quality
                     token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                if session.llm_end is True and len(session.speech_tokens) < token_hop_len + self.token_overlap_len:
                     break
+            session.llm_thread.join()
+            if session.llm_error is not None:
+                raise session.llm_error
+            if cancel_event is not None and cancel_event.is_set():
+                return
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
+                                             session=session,
+                                             finalize=True,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            session.llm_thread.join()
+            if session.llm_error is not None:
+                raise session.llm_error
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
                                              finalize=True,
-                                             speed=speed)
+                                             speed=speed,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+
+    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0,
+           quality='high', n_timesteps=None, cancel_event=None, **kwargs):
+        solver, n_timesteps = self.flow_solver(quality, n_timesteps)
+        with self.session_pool.session() as session:
+            session.speech_tokens, session.llm_end = source_speech_token.flatten().tolist(), True
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    if len(session.speech_tokens) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(session.speech_tokens[:token_hop_len + self.token_overlap_len]).unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         session=session,
+                                                         finalize=False,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        session.speech_tokens = session.speech_tokens[token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if session.llm_end is True and len(session.speech_tokens) < token_hop_len + self.token_overlap_len:
+                        break
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                this_tts_speech_token = torch.tensor(session.speech_tokens).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True,
+                                                 speed=speed,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver)
+                yield {'tts_speech': this_tts_speech.cpu()}
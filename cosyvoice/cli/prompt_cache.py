@@ -0,0 +1,126 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Content addressed cache of prompt features used by zero-shot, cross-lingual and vc frontends."""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import torch
+
+
+class PromptCache:
+    """LRU cache of prompt features, keyed by a hash of the prompt audio and text.
+
+    The memory tier is bounded by the total size of the cached tensors and
+    evicts the least recently used prompt first. If cache_dir is given, every
+    computed prompt is also written to cache_dir/<key>.pt and memory misses
+    are looked up there before computing, so a restarted server does not have
+    to extract features of its reference voices again. The disk tier is not
+    bounded, remove stale files yourself.
+
+    Both tiers keep their tensors on cpu, a hit is copied to device, so the
+    cache never holds gpu memory. On a cpu device cached tensors are shared by
+    all requests using the same prompt, callers must not modify them in place.
+
+    Args:
+        max_size_mb (float): max size of the memory tier, 0 disables it.
+        cache_dir (str): directory of the disk tier, None disables it.
+        device (torch.device): device the returned tensors are moved to.
+    """
+
+    def __init__(self, max_size_mb: float = 256, cache_dir: Optional[str] = None, device: torch.device = torch.device('cpu')):
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.cache_dir = cache_dir
+        self.device = device
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(prompt_speech_16k: torch.Tensor, prompt_text: str = '') -> str:
+        h = hashlib.sha256()
+        h.update(str(tuple(prompt_speech_16k.shape)).encode('utf-8'))
+        h.update(prompt_speech_16k.detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+        h.update(prompt_text.encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def nbytes(entry: Dict[str, torch.Tensor]) -> int:
+        return sum(v.numel() * v.element_size() for v in entry.values())
+
+    def get_or_compute(self, prompt_speech_16k: torch.Tensor, prompt_text: str,
+                       compute: Callable[[], Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        """Return the cached features of the prompt, call compute and cache its result on a miss."""
+        key = self.key(prompt_speech_16k, prompt_text)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return {k: v.to(self.device) for k, v in entry.items()}
+        entry = self._load(key)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            computed = compute()
+            entry = {k: v.cpu() for k, v in computed.items()}
+            self._save(key, entry)
+            self._put(key, entry)
+            return computed
+        self._put(key, entry)
+        return {k: v.to(self.device) for k, v in entry.items()}
+
+    def _put(self, key: str, entry: Dict[str, torch.Tensor]):
+        size = self.nbytes(entry)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.nbytes(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, '{}.pt'.format(key))
+
+    def _load(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            return torch.load(self._path(key), map_location='cpu', weights_only=True)
+        except Exception:
+            logging.warning('failed to load prompt cache {}, recompute it'.format(self._path(key)))
+            return None
+
+    def _save(self, key: str, entry: Dict[str, torch.Tensor]):
+        if self.cache_dir is None:
+            return
+        # write to a temporary file first, so concurrent readers never see a partial file
+        tmp_path = '{}.{}.tmp'.format(self._path(key), threading.get_ident())
+        torch.save(entry, tmp_path)
+        os.replace(tmp_path, self._path(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
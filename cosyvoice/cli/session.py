@@ -0,0 +1,100 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per request state of CosyVoiceModel.tts and CosyVoiceModel.vc."""
+import threading
+from contextlib import contextmanager
+from typing import Generator, List, Optional
+
+import torch
+
+
+class TTSSession:
+    """State of one tts/vc request, shared by token2wav and the llm_job thread.
+
+    speech_tokens and llm_end are guarded by token_cond, llm_job notifies it
+    whenever a token is appended or decoding ends.
+    """
+
+    __slots__ = ('speech_tokens', 'llm_end', 'llm_error', 'llm_thread', 'token_cond', 'cancel_event',
+                 'mel_overlap', 'flow_cache', 'hift_cache', 'hift_stream')
+
+    def __init__(self):
+        self.token_cond = threading.Condition()
+        self.cancel_event = threading.Event()
+        self.reset()
+
+    def reset(self):
+        """Drop all tensors and tokens, so that a released session holds no memory."""
+        self.speech_tokens: List[int] = []
+        self.llm_end = False
+        self.llm_error: Optional[Exception] = None
+        self.llm_thread: Optional[threading.Thread] = None
+        self.cancel_event.clear()
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        self.hift_cache = None
+        self.hift_stream = None
+
+    def cancel(self):
+        """Ask llm_job to stop decoding, it stops before the next speech token is appended."""
+        self.cancel_event.set()
+        with self.token_cond:
+            self.token_cond.notify_all()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+
+class SessionPool:
+    """Bounded pool of TTSSession.
+
+    At most max_sessions sessions are active at the same time, further
+    requests wait for a free session. Released sessions are cancelled, their
+    llm_job thread is joined and their state is dropped before reuse, so the
+    memory of a long running server does not grow with the number of served
+    requests, even when clients disconnect in the middle of a stream.
+
+    Args:
+        max_sessions (int): max number of concurrent sessions.
+    """
+
+    def __init__(self, max_sessions: int = 64):
+        assert max_sessions >= 1
+        self.max_sessions = max_sessions
+        self.semaphore = threading.BoundedSemaphore(max_sessions)
+        self.lock = threading.Lock()
+        self.free: List[TTSSession] = []
+
+    @contextmanager
+    def session(self, timeout: Optional[float] = None) -> Generator[TTSSession, None, None]:
+        """Acquire a session for the duration of the with block.
+
+        Raises:
+            RuntimeError: if no session becomes free within timeout seconds.
+        """
+        if not self.semaphore.acquire(timeout=timeout):
+            raise RuntimeError('all {} tts sessions are busy'.format(self.max_sessions))
+        with self.lock:
+            session = self.free.pop() if len(self.free) != 0 else TTSSession()
+        try:
+            yield session
+        finally:
+            session.cancel()
+            if session.llm_thread is not None:
+                session.llm_thread.join()
+            session.reset()
+            with self.lock:
+                self.free.append(session)
+            self.semaphore.release()
@@ -21,6 +21,8 @@ import torchaudio
 from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
 
+from cosyvoice.utils.audio_utils import resample as resample_waveform
+
 torchaudio.set_audio_backend('soundfile')
 
 AUDIO_FORMAT_SETS = {'flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'}
@@ -127,8 +129,7 @@ def resample(data, resample_rate=22050, min_sample_rate=16000, mode='train'):
             if sample_rate < min_sample_rate:
                 continue
             sample['sample_rate'] = resample_rate
-            sample['speech'] = torchaudio.transforms.Resample(
-                orig_freq=sample_rate, new_freq=resample_rate)(waveform)
+            sample['speech'] = resample_waveform(waveform, sample_rate, resample_rate)
         max_val = sample['speech'].abs().max()
         if max_val > 1:
             sample['speech'] /= max_val
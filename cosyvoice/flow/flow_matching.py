@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import numpy as np
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
@@ -18,6 +19,16 @@ from matcha.models.components.flow_matching import BASECFM
 import os, sys
 sys.path.insert(0, os.path.abspath(r'E:\2_PYTHON\Project\GPT\QWen\CosyVoice\third_party\Matcha-TTS'))
 
+TORCH_TO_NUMPY_DTYPE = {torch.float32: np.float32, torch.float16: np.float16}
+
+# quality tiers of flow decoding, name -> (solver, n_timesteps), solver None means the solver in cfm_params
+FLOW_QUALITY_TIERS = {
+    'high': (None, 10),
+    'balanced': ('multistep', 6),
+    'fast': ('multistep', 4),
+}
+
+
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
@@ -32,9 +43,19 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # ode solvers, name -> method, number of estimator calls per step is 1 for euler, multistep and cached,
+        # 2 for heun and midpoint, cached only calls the estimator every other step
+        self.solvers = {
+            'euler': self.solve_euler,
+            'heun': self.solve_heun,
+            'midpoint': self.solve_midpoint,
+            'multistep': self.solve_multistep,
+            'cached': self.solve_cached,
+        }
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2),
+                solver=None):
         """Forward diffusion
 
         Args:
@@ -47,11 +68,15 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver, one of self.solvers. Defaults to cfm_params.solver.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
+        solver = self.solver if solver is None else solver
+        if solver not in self.solvers:
+            raise ValueError('unsupported ode solver {}, choose from {}'.format(solver, list(self.solvers.keys())))
 
         z = torch.randn_like(mu) * temperature
         cache_size = flow_cache.shape[2]
@@ -66,7 +91,35 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solvers[solver](z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+
+    def velocity_fn(self, mu, mask, spks, cond):
+        """
+        Build the guided velocity v(x, t) of the ode.
+        Classifier-Free Guidance inference introduced in VoiceBox,
+        the conditional and the unconditional branch are stacked into one batch of 2 * batch_size,
+        so that every velocity runs the estimator once, the constant inputs are only built once.
+        """
+        if self.inference_cfg_rate <= 0:
+            estimator = self.estimator_fn(mask, mu, spks, cond)
+            if isinstance(self.estimator, torch.nn.Module):
+                return estimator
+            # the output buffer of the onnxruntime session is reused by the next call, solvers keep velocities across calls
+            return lambda x, t: estimator(x, t).clone()
+        batch_size = mu.size(0)
+        estimator = self.estimator_fn(
+            torch.concat([mask, mask], dim=0),
+            torch.concat([mu, torch.zeros_like(mu)], dim=0),
+            torch.concat([spks, torch.zeros_like(spks)], dim=0) if spks is not None else None,
+            torch.concat([cond, torch.zeros_like(cond)], dim=0) if cond is not None else None
+        )
+
+        def velocity(x, t):
+            dphi_dt = estimator(torch.concat([x, x], dim=0), t.expand(2 * batch_size))
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, batch_size, dim=0)
+            return ((1.0 + self.inference_cfg_rate) * dphi_dt -
+                    self.inference_cfg_rate * cfg_dphi_dt)
+        return velocity
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -85,23 +138,14 @@ class ConditionalCFM(BASECFM):
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
+        velocity = self.velocity_fn(mu, mask, spks, cond)
 
         # I am storing this because I can later plot it by putting a debugger here and saving it to a file
         # Or in future might add like a return_all_steps flag
         sol = []
 
         for step in range(1, len(t_span)):
-            dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond)
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
-                cfg_dphi_dt = self.forward_estimator(
-                    x, mask,
-                    torch.zeros_like(mu), t,
-                    torch.zeros_like(spks) if spks is not None else None,
-                    torch.zeros_like(cond)
-                )
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
-                           self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = velocity(x, t)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -110,20 +154,105 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1]
 
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        """
+        Heun (second order runge kutta) solver, 2 estimator calls per step,
+        arguments are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            k1 = velocity(x, t)
+            k2 = velocity(x + dt * k1, t + dt)
+            x = x + dt * 0.5 * (k1 + k2)
+        return x
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        """
+        Midpoint solver, 2 estimator calls per step,
+        arguments are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            k1 = velocity(x, t)
+            x = x + dt * velocity(x + 0.5 * dt * k1, t + 0.5 * dt)
+        return x
+
+    def solve_multistep(self, x, t_span, mu, mask, spks, cond):
+        """
+        Second order multistep solver in the spirit of DPM-Solver++(2M), the velocity of
+        the previous step is reused to extrapolate the current one (variable step adams-bashforth),
+        1 estimator call per step, arguments are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        prev_dphi_dt, prev_dt = None, None
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = velocity(x, t)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                r = dt / (2 * prev_dt)
+                x = x + dt * ((1 + r) * dphi_dt - r * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x
+
+    def solve_cached(self, x, t_span, mu, mask, spks, cond):
+        """
+        Euler solver which reuses the cached velocity of the previous step on every other step,
+        the estimator is called ceil(n_timesteps / 2) times, arguments are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        dphi_dt = None
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            if step % 2 == 1:
+                dphi_dt = velocity(x, t)
+            x = x + dt * dphi_dt
+        return x
+
     def forward_estimator(self, x, mask, mu, t, spks, cond):
+        return self.estimator_fn(mask, mu, spks, cond)(x, t)
+
+    def estimator_fn(self, mask, mu, spks, cond):
+        """
+        Build f(x, t) which runs the estimator with constant mask, mu, spks and cond.
+        For an onnxruntime session, the constant inputs and the output buffer are bound once by io binding
+        and only x and t are bound per call, tensors already on the device of the session are bound without copy.
+        The returned tensor is the output buffer of the session, it is overwritten by the next call.
+        """
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+            return lambda x, t: self.estimator.forward(x, mask, mu, t, spks, cond)
+        session = self.estimator
+        if mu.device.type == 'cuda' and 'CUDAExecutionProvider' in session.get_providers():
+            device = mu.device
         else:
-            ort_inputs = {
-                'x': x.cpu().numpy(),
-                'mask': mask.cpu().numpy(),
-                'mu': mu.cpu().numpy(),
-                't': t.cpu().numpy(),
-                'spks': spks.cpu().numpy(),
-                'cond': cond.cpu().numpy()
-            }
-            output = self.estimator.run(None, ort_inputs)[0]
-            return torch.tensor(output, dtype=x.dtype, device=x.device)
+            device = torch.device('cpu')
+        binding = session.io_binding()
+        # bound tensors are kept alive here, io binding only keeps their pointers
+        bound = {}
+
+        def bind_input(name, tensor):
+            tensor = tensor.to(device).contiguous()
+            bound[name] = tensor
+            binding.bind_input(name, device.type, device.index or 0, TORCH_TO_NUMPY_DTYPE[tensor.dtype], tuple(tensor.shape), tensor.data_ptr())
+
+        for name, tensor in (('mask', mask), ('mu', mu), ('spks', spks), ('cond', cond)):
+            bind_input(name, tensor)
+        output = torch.empty(mu.shape, dtype=mu.dtype, device=device)
+        binding.bind_output(session.get_outputs()[0].name, device.type, device.index or 0, TORCH_TO_NUMPY_DTYPE[output.dtype],
+                            tuple(output.shape), output.data_ptr())
+
+        def estimator(x, t):
+            bind_input('x', x)
+            bind_input('t', t)
+            if device.type == 'cuda':
+                # onnxruntime runs on its own cuda stream, inputs written by torch must be ready
+                torch.cuda.current_stream(device).synchronize()
+            session.run_with_iobinding(binding)
+            return output.to(x.device)
+        return estimator
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
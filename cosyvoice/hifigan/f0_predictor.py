@@ -13,7 +13,7 @@
 # limitations under the License.
 import torch
 import torch.nn as nn
-from torch.nn.utils import weight_norm
+from torch.nn.utils import remove_weight_norm, weight_norm
 
 
 class ConvRNNF0Predictor(nn.Module):
@@ -49,6 +49,11 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
+    def remove_weight_norm(self):
+        for l in self.condnet:
+            if isinstance(l, nn.Conv1d):
+                remove_weight_norm(l)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.condnet(x)
         x = x.transpose(1, 2)
@@ -134,10 +134,19 @@ class SineGen(torch.nn.Module):
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def sample_random(self, batch_size: int, length: int, device: torch.device):
+        """Draw the random initial phase (batch, harmonic_num + 1, 1) and the standard normal noise (batch, harmonic_num + 1, length) of forward."""
+        u_dist = Uniform(low=-np.pi, high=np.pi)
+        phase_vec = u_dist.sample(sample_shape=(batch_size, self.harmonic_num + 1, 1)).to(device)
+        phase_vec[:, 0, :] = 0
+        noise = torch.randn(batch_size, self.harmonic_num + 1, length, device=device)
+        return phase_vec, noise
+
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, phase_vec=None, noise=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param phase_vec, noise: random values of sample_random, drawn here if not given
         :return: [B, 1, sample_len]
         """
 
@@ -146,9 +155,10 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        if phase_vec is None:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+            phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -160,7 +170,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * (torch.randn_like(sine_waves) if noise is None else noise)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -201,16 +211,17 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase_vec=None, noise=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
+        phase_vec, noise: random values of the sine generator, see SineGen.sample_random
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), phase_vec, noise)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -324,13 +335,13 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
+        self.f0_predictor.remove_weight_norm()
         for l in self.source_resblocks:
             l.remove_weight_norm()
 
     def _stft(self, x):
+        if torch.onnx.is_in_onnx_export():
+            return self._conv_stft(x)
         spec = torch.stft(
             x,
             self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
@@ -342,10 +353,42 @@ class HiFTGenerator(nn.Module):
         magnitude = torch.clip(magnitude, max=1e2)
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
+        if torch.onnx.is_in_onnx_export():
+            return self._conv_istft(real, img)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
+    def _dft_basis(self, device):
+        # (n_fft // 2 + 1, n_fft) cos and sin of the onesided dft
+        n_fft = self.istft_params["n_fft"]
+        k = torch.arange(n_fft // 2 + 1, dtype=torch.float64).unsqueeze(1)
+        n = torch.arange(n_fft, dtype=torch.float64).unsqueeze(0)
+        return torch.cos(2 * np.pi * k * n / n_fft).float().to(device), torch.sin(2 * np.pi * k * n / n_fft).float().to(device)
+
+    def _conv_stft(self, x):
+        # torch.stft(center=True) as a strided conv with the windowed dft basis, stft and complex ops are not exportable
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        cos, sin = self._dft_basis(x.device)
+        window = self.stft_window.to(x.device)
+        kernel = torch.concat([cos * window, -sin * window], dim=0).unsqueeze(1)
+        x = F.pad(x.unsqueeze(1), (n_fft // 2, n_fft // 2), mode='reflect')
+        spec = F.conv1d(x, kernel, stride=hop_len)
+        return spec[:, :n_fft // 2 + 1], spec[:, n_fft // 2 + 1:]
+
+    def _conv_istft(self, real, img):
+        # torch.istft(center=True) as a strided transposed conv with the windowed inverse dft basis, normalized by the window envelope
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        cos, sin = self._dft_basis(real.device)
+        window = self.stft_window.to(real.device)
+        # dc and nyquist appear once in the onesided spectrum, other bins twice, their imaginary parts are ignored like irfft does
+        scale = torch.full((n_fft // 2 + 1, 1), 2.0, device=real.device)
+        scale[0], scale[-1] = 1.0, 1.0
+        kernel = torch.concat([cos * scale * window, -sin * scale * window], dim=0).unsqueeze(1) / n_fft
+        y = F.conv_transpose1d(torch.concat([real, img], dim=1), kernel, stride=hop_len)
+        envelope = F.conv_transpose1d(torch.ones_like(real[:, :1]), window.pow(2).view(1, 1, -1), stride=hop_len)
+        return (y / envelope)[:, 0, n_fft // 2: -(n_fft // 2)]
+
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
@@ -398,14 +441,21 @@ class HiFTGenerator(nn.Module):
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+        return self.synthesize(speech_feat, cache_source)
+
+    def synthesize(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0),
+                   phase_vec: Optional[torch.Tensor] = None, noise: Optional[torch.Tensor] = None):
+        """Same as inference without inference_mode, the random values of the source can be given, see SineGen.sample_random.
+
+        Exported to onnx with phase_vec and noise as inputs, so that the graph is deterministic.
+        """
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(s, phase_vec, noise)
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
-        if cache_source.shape[2] != 0:
-            s[:, :, :cache_source.shape[2]] = cache_source
+        s = torch.concat([cache_source, s[:, :, cache_source.shape[2]:]], dim=2)
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
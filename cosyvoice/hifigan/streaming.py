@@ -0,0 +1,326 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stateful streaming inference of HiFTGenerator.
+
+The convolutions of HiFT are not causal, every layer looks a few steps into
+the future. Each streaming op below keeps the left context it needs and
+only emits the outputs whose right context has arrived, the rest is emitted
+once more input arrives or the stream is finalized, which applies the right
+padding of the offline layer. So every chunk only computes new samples and
+the concatenated chunks equal HiFTGenerator.decode of the whole mel, up to
+the random phase and noise of the source.
+"""
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributions.uniform import Uniform
+
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+from cosyvoice.hifigan.generator import HiFTGenerator, ResBlock
+
+
+def _cat(x: Optional[torch.Tensor], y: torch.Tensor) -> torch.Tensor:
+    return y if x is None else torch.concat([x, y], dim=-1)
+
+
+def _weight(module: nn.Module) -> torch.Tensor:
+    # run the weight norm pre hook, so that module.weight reflects weight_g and weight_v
+    for hook in module._forward_pre_hooks.values():
+        hook(module, None)
+    return module.weight
+
+
+class _StreamConv1d:
+    """Conv1d with symmetric zero padding, stride and dilation."""
+
+    def __init__(self, conv: nn.Conv1d):
+        self.weight, self.bias = _weight(conv), conv.bias
+        self.stride, self.dilation, self.padding = conv.stride[0], conv.dilation[0], conv.padding[0]
+        self.receptive_field = (conv.kernel_size[0] - 1) * self.dilation + 1
+        self.cache = None
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        if self.cache is None:
+            self.cache = x.new_zeros(x.size(0), x.size(1), self.padding)
+        x = torch.concat([self.cache, x] + ([x.new_zeros(x.size(0), x.size(1), self.padding)] if final else []), dim=-1)
+        n = (x.size(-1) - self.receptive_field) // self.stride + 1 if x.size(-1) >= self.receptive_field else 0
+        self.cache = x[..., n * self.stride:]
+        if n == 0:
+            return x.new_zeros(x.size(0), self.weight.size(0), 0)
+        return F.conv1d(x[..., :(n - 1) * self.stride + self.receptive_field], self.weight, self.bias, self.stride, 0, self.dilation)
+
+
+class _StreamConvTranspose1d:
+    """ConvTranspose1d with symmetric cropping, overlapping outputs of neighbouring chunks are added up."""
+
+    def __init__(self, conv: nn.ConvTranspose1d):
+        self.weight, self.bias = _weight(conv), conv.bias
+        self.stride, self.padding = conv.stride[0], conv.padding[0]
+        assert self.padding <= conv.kernel_size[0] - self.stride
+        self.pending = None
+        self.to_drop = self.padding
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        if x.size(-1) != 0:
+            y = F.conv_transpose1d(x, self.weight, None, self.stride)
+            if self.pending is not None:
+                y = torch.concat([y[..., :self.pending.size(-1)] + self.pending, y[..., self.pending.size(-1):]], dim=-1)
+            self.pending = y[..., x.size(-1) * self.stride:]
+            y = y[..., :x.size(-1) * self.stride]
+        else:
+            y = x.new_zeros(x.size(0), self.weight.size(1), 0)
+        if final and self.pending is not None:
+            y = torch.concat([y, self.pending[..., :self.pending.size(-1) - self.padding]], dim=-1)
+        y, self.to_drop = y[..., self.to_drop:], max(0, self.to_drop - y.size(-1))
+        return y + self.bias.unsqueeze(-1) if self.bias is not None else y
+
+
+class _Pointwise:
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        return self.fn(x)
+
+
+class _Chain:
+
+    def __init__(self, ops: List):
+        self.ops = ops
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        for op in self.ops:
+            x = op(x, final)
+        return x
+
+
+class _Residual:
+    """x + branch(x), x is buffered until the delayed branch output catches up."""
+
+    def __init__(self, branch):
+        self.branch = branch
+        self.skip = None
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        self.skip = _cat(self.skip, x)
+        y = self.branch(x, final)
+        y, self.skip = y + self.skip[..., :y.size(-1)], self.skip[..., y.size(-1):]
+        return y
+
+
+class _Mean:
+    """Mean of parallel branches of different delays."""
+
+    def __init__(self, branches: List):
+        self.branches = branches
+        self.buffers = [None] * len(branches)
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        self.buffers = [_cat(buffer, branch(x, final)) for buffer, branch in zip(self.buffers, self.branches)]
+        n = min(buffer.size(-1) for buffer in self.buffers)
+        y = sum(buffer[..., :n] for buffer in self.buffers) / len(self.buffers)
+        self.buffers = [buffer[..., n:] for buffer in self.buffers]
+        return y
+
+
+class _Add:
+    """Sum of two streams of different delays."""
+
+    def __init__(self):
+        self.x, self.y = None, None
+
+    def __call__(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        self.x, self.y = _cat(self.x, x), _cat(self.y, y)
+        n = min(self.x.size(-1), self.y.size(-1))
+        z = self.x[..., :n] + self.y[..., :n]
+        self.x, self.y = self.x[..., n:], self.y[..., n:]
+        return z
+
+
+class _LeftReflectionPad:
+    """nn.ReflectionPad1d((pad, 0)), waits for pad + 1 steps before emitting."""
+
+    def __init__(self, pad: int):
+        self.pad = pad
+        self.buffer = None
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        if self.pad == 0:
+            return x
+        self.buffer = _cat(self.buffer, x)
+        if self.buffer.size(-1) <= self.pad and not final:
+            return x[..., :0]
+        y = torch.concat([self.buffer[..., 1: self.pad + 1].flip(-1), self.buffer], dim=-1)
+        self.buffer, self.pad = None, 0
+        return y
+
+
+class _StreamSTFT:
+    """torch.stft(center=True, reflect padding) of a (batch, samples) stream, returns (batch, 2 * (n_fft // 2 + 1), frames)."""
+
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        self.n_fft, self.hop_len, self.window = n_fft, hop_len, window
+        self.buffer = None
+        self.started = False
+
+    def __call__(self, x: torch.Tensor, final: bool = False) -> torch.Tensor:
+        pad = self.n_fft // 2
+        self.buffer = _cat(self.buffer, x)
+        if not self.started:
+            if self.buffer.size(-1) <= pad and not final:
+                return x.new_zeros(x.size(0), self.n_fft + 2, 0)
+            self.buffer = torch.concat([self.buffer[..., 1: pad + 1].flip(-1), self.buffer], dim=-1)
+            self.started = True
+        if final:
+            self.buffer = torch.concat([self.buffer, self.buffer[..., -pad - 1: -1].flip(-1)], dim=-1)
+        n = (self.buffer.size(-1) - self.n_fft) // self.hop_len + 1 if self.buffer.size(-1) >= self.n_fft else 0
+        frames = self.buffer[..., :(n - 1) * self.hop_len + self.n_fft].unfold(-1, self.n_fft, self.hop_len) if n > 0 else None
+        self.buffer = self.buffer[..., n * self.hop_len:]
+        if frames is None:
+            return x.new_zeros(x.size(0), self.n_fft + 2, 0)
+        spec = torch.fft.rfft(frames * self.window.to(frames.device), dim=-1).transpose(1, 2)
+        return torch.concat([spec.real, spec.imag], dim=1)
+
+
+class _StreamISTFT:
+    """torch.istft(center=True) of a (batch, n_fft // 2 + 1, frames) magnitude and phase stream."""
+
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        self.n_fft, self.hop_len, self.window = n_fft, hop_len, window
+        self.pending, self.pending_envelope = None, None
+        self.to_drop = n_fft // 2
+
+    def _overlap_add(self, frames: torch.Tensor) -> torch.Tensor:
+        # frames (batch, n_fft, num_frames) -> (batch, (num_frames - 1) * hop_len + n_fft)
+        length = (frames.size(-1) - 1) * self.hop_len + self.n_fft
+        return F.fold(frames, output_size=(1, length), kernel_size=(1, self.n_fft), stride=(1, self.hop_len)).view(frames.size(0), length)
+
+    def __call__(self, magnitude: torch.Tensor, phase: torch.Tensor, final: bool = False) -> torch.Tensor:
+        n = magnitude.size(-1)
+        window = self.window.to(magnitude.device)
+        if n != 0:
+            magnitude = torch.clip(magnitude, max=1e2)
+            spec = torch.complex(magnitude * torch.cos(phase), magnitude * torch.sin(phase))
+            frames = torch.fft.irfft(spec, n=self.n_fft, dim=1) * window.unsqueeze(-1)
+            y = self._overlap_add(frames)
+            envelope = self._overlap_add(window.pow(2).view(1, -1, 1).expand(1, -1, n))
+            if self.pending is not None:
+                overlap = self.pending.size(-1)
+                y = torch.concat([y[..., :overlap] + self.pending, y[..., overlap:]], dim=-1)
+                envelope = torch.concat([envelope[..., :overlap] + self.pending_envelope, envelope[..., overlap:]], dim=-1)
+            self.pending, self.pending_envelope = y[..., n * self.hop_len:], envelope[..., n * self.hop_len:]
+            y, envelope = y[..., :n * self.hop_len], envelope[..., :n * self.hop_len]
+        else:
+            y, envelope = magnitude.new_zeros(magnitude.size(0), 0), magnitude.new_zeros(1, 0)
+        if final and self.pending is not None:
+            tail = self.n_fft - self.hop_len - self.n_fft // 2
+            y, envelope = torch.concat([y, self.pending[..., :tail]], dim=-1), torch.concat([envelope, self.pending_envelope[..., :tail]], dim=-1)
+        y, envelope, self.to_drop = y[..., self.to_drop:], envelope[..., self.to_drop:], max(0, self.to_drop - y.size(-1))
+        return y / envelope
+
+
+class _StreamSource:
+    """SourceModuleHnNSF of an upsampled f0 stream, the harmonic phase is carried over chunks."""
+
+    def __init__(self, hift: HiFTGenerator):
+        self.sine_gen = hift.m_source.l_sin_gen
+        self.l_linear, self.l_tanh = hift.m_source.l_linear, hift.m_source.l_tanh
+        self.phase, self.phase_vec = None, None
+
+    def __call__(self, f0: torch.Tensor, final: bool = False) -> torch.Tensor:
+        # f0 (batch, samples) -> source (batch, samples)
+        sine_gen = self.sine_gen
+        harmonics = torch.arange(1, sine_gen.harmonic_num + 2, device=f0.device, dtype=f0.dtype).view(1, -1, 1)
+        f_mat = f0.unsqueeze(1) * harmonics / sine_gen.sampling_rate
+        if self.phase is None:
+            self.phase = f_mat.new_zeros(f_mat.size(0), f_mat.size(1), 1)
+            self.phase_vec = Uniform(low=-np.pi, high=np.pi).sample(sample_shape=(f0.size(0), sine_gen.harmonic_num + 1, 1)).to(f0.device)
+            self.phase_vec[:, 0, :] = 0
+        cumsum = torch.cumsum(f_mat, dim=-1) + self.phase
+        if cumsum.size(-1) != 0:
+            self.phase = cumsum[..., -1:] % 1
+        sine_waves = sine_gen.sine_amp * torch.sin(2 * np.pi * (cumsum % 1) + self.phase_vec)
+        uv = sine_gen._f02uv(f0.unsqueeze(1))
+        noise_amp = uv * sine_gen.noise_std + (1 - uv) * sine_gen.sine_amp / 3
+        sine_waves = sine_waves * uv + noise_amp * torch.randn_like(sine_waves)
+        return self.l_tanh(self.l_linear(sine_waves.transpose(1, 2))).squeeze(-1)
+
+
+def _stream_resblock(resblock: ResBlock) -> _Chain:
+    return _Chain([_Residual(_Chain([_Pointwise(resblock.activations1[i]), _StreamConv1d(resblock.convs1[i]),
+                                     _Pointwise(resblock.activations2[i]), _StreamConv1d(resblock.convs2[i])]))
+                   for i in range(len(resblock.convs1))])
+
+
+class HiFTStreamer:
+    """Stateful streaming vocoder of one utterance, shares the weights of hift.
+
+    Feed consecutive mel chunks, call with final=True on the last one (it may
+    be empty) to flush the lookahead of all layers. The returned speech chunks
+    concatenate to the offline result, the first ones are shorter by the
+    lookahead of the vocoder (about 20 mel frames).
+
+    Example:
+        streamer = HiFTStreamer(hift)
+        for mel in mel_chunks:
+            yield streamer(mel)
+        yield streamer(mel_chunks.new_zeros(1, 80, 0), final=True)
+    """
+
+    def __init__(self, hift: HiFTGenerator):
+        assert isinstance(hift.f0_predictor, ConvRNNF0Predictor), 'streaming only supports ConvRNNF0Predictor'
+        self.hift = hift
+        self.f0_condnet = _Chain([_StreamConv1d(m) if isinstance(m, nn.Conv1d) else _Pointwise(m) for m in hift.f0_predictor.condnet])
+        self.upsample_scale = int(np.prod([up.stride[0] for up in hift.ups]) * hift.istft_params['hop_len'])
+        self.source = _StreamSource(hift)
+        self.stft = _StreamSTFT(hift.istft_params['n_fft'], hift.istft_params['hop_len'], hift.stft_window)
+        self.source_branches = [_Chain([_StreamConv1d(hift.source_downs[i]), _stream_resblock(hift.source_resblocks[i])])
+                                for i in range(hift.num_upsamples)]
+        self.conv_pre = _StreamConv1d(hift.conv_pre)
+        self.ups = [_StreamConvTranspose1d(up) for up in hift.ups]
+        self.reflection_pad = _LeftReflectionPad(hift.reflection_pad.padding[0])
+        self.adds = [_Add() for _ in range(hift.num_upsamples)]
+        self.resblocks = [_Mean([_stream_resblock(hift.resblocks[i * hift.num_kernels + j]) for j in range(hift.num_kernels)])
+                          for i in range(hift.num_upsamples)]
+        self.conv_post = _StreamConv1d(hift.conv_post)
+        self.istft = _StreamISTFT(hift.istft_params['n_fft'], hift.istft_params['hop_len'], hift.stft_window)
+
+    @torch.inference_mode()
+    def __call__(self, speech_feat: torch.Tensor, final: bool = False) -> torch.Tensor:
+        """Vocode the next (1, 80, frames) mel chunk, returns (1, samples) speech."""
+        hift = self.hift
+        # mel->f0->source, f0 runs behind the mel by the lookahead of the f0 predictor
+        f0 = self.f0_condnet(speech_feat, final)
+        f0 = torch.abs(hift.f0_predictor.classifier(f0.transpose(1, 2)).squeeze(-1))
+        s = self.source(f0.repeat_interleave(self.upsample_scale, dim=-1), final)
+        s_stft = self.stft(s, final)
+
+        x = self.conv_pre(speech_feat, final)
+        for i in range(hift.num_upsamples):
+            x = F.leaky_relu(x, hift.lrelu_slope)
+            x = self.ups[i](x, final)
+            if i == hift.num_upsamples - 1:
+                x = self.reflection_pad(x, final)
+            x = self.adds[i](x, self.source_branches[i](s_stft, final))
+            x = self.resblocks[i](x, final)
+        x = F.leaky_relu(x)
+        x = self.conv_post(x, final)
+        magnitude = torch.exp(x[:, :hift.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, hift.istft_params["n_fft"] // 2 + 1:, :])
+        x = self.istft(magnitude, phase, final)
+        return torch.clamp(x, -hift.audio_limit, hift.audio_limit)
@@ -11,14 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Tuple, Union
+import threading
 import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.transformer.kv_cache import KVCache
+from cosyvoice.utils.common import th_accuracy, TokenRingBuffer
 
 
 class TransformerLM(torch.nn.Module):
@@ -98,6 +100,17 @@ class TransformerLM(torch.nn.Module):
             audio: (B, T, N) or (B, T)
             audio_lengths: (B,)
         """
+        logits, lm_target = self.forward_logits(batch, device)
+        loss = self.criterion_ce(logits, lm_target)
+        acc = th_accuracy(logits.view(-1, self.speech_token_size + 1), lm_target, ignore_label=IGNORE_ID)
+        return {'loss': loss, 'acc': acc}
+
+    def forward_logits(
+            self,
+            batch: dict,
+            device: torch.device,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Teacher forcing logits (B, T, speech_token_size + 1) of batch and their targets (B, T), IGNORE_ID targets are not predicted."""
         text_token = batch['text_token'].to(device)
         text_token_len = batch['text_token_len'].to(device)
         speech_token = batch['speech_token'].to(device)
@@ -132,25 +145,35 @@ class TransformerLM(torch.nn.Module):
         # 6. run lm forward
         lm_output, lm_output_mask = self.llm(lm_input, lm_input_len.to(device))
         logits = self.llm_decoder(lm_output)
-        loss = self.criterion_ce(logits, lm_target)
-        acc = th_accuracy(logits.view(-1, self.speech_token_size + 1), lm_target, ignore_label=IGNORE_ID)
-        return {'loss': loss, 'acc': acc}
+        return logits, lm_target
 
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, TokenRingBuffer],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
     ):
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-        return top_ids
+        """Sample the next token ids in a single pass.
 
-    @torch.inference_mode()
-    def inference(
+        Args:
+            weighted_scores (torch.Tensor): log probs (vocab, ) or (batch, vocab).
+            decoded_tokens (List or TokenRingBuffer): previously decoded tokens.
+            sampling (int): sampling argument passed to self.sampling, a list
+                of one value per session when weighted_scores is batched.
+            ignore_eos (bool or torch.Tensor): forbid eos, or (batch, ) bool
+                tensor to forbid eos per session.
+        """
+        # mask eos instead of resampling until a non eos token is drawn
+        if isinstance(ignore_eos, torch.Tensor):
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., self.speech_token_size].masked_fill_(ignore_eos, -float('inf'))
+        elif ignore_eos:
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., self.speech_token_size] = -float('inf')
+        return self.sampling(weighted_scores, decoded_tokens, sampling)
+
+    def prepare_lm_input(
             self,
             text: torch.Tensor,
             text_len: torch.Tensor,
@@ -159,10 +182,16 @@ class TransformerLM(torch.nn.Module):
             prompt_speech_token: torch.Tensor,
             prompt_speech_token_len: torch.Tensor,
             embedding: torch.Tensor,
-            sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
-    ) -> Generator[torch.Tensor, None, None]:
+    ) -> Tuple[torch.Tensor, int, int]:
+        """Build the prefill input of the speech token decoder.
+
+        Returns:
+            torch.Tensor: llm input (1, T, llm_input_size)
+            int: min number of speech tokens to decode before eos is allowed
+            int: max number of speech tokens to decode
+        """
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
@@ -191,22 +220,57 @@ class TransformerLM(torch.nn.Module):
         # 4. cal min/max_length
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        return lm_input, min_len, max_len
+
+    @torch.inference_mode()
+    def inference(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            cancel_event: Optional[threading.Event] = None,
+    ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                                           prompt_speech_token, prompt_speech_token_len, embedding,
+                                                           max_token_text_ratio=max_token_text_ratio,
+                                                           min_token_text_ratio=min_token_text_ratio)
 
-        # 5. step by step decode
-        out_tokens = []
+        # 5. step by step decode, after the prefill the kv cache is written in place if llm supports it,
+        # jit models exported before forward_chunk_inplace was added still concat the cache every step
+        out_tokens = TokenRingBuffer(device=lm_input.device)
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        kv_cache = None
+        # the causal mask is only needed by the prefill, every following step feeds a single token which
+        # attends to the whole cache, so it uses the fake mask and no mask is built or applied per step
+        att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+        step_att_mask = torch.ones((0, 0, 0), dtype=torch.bool)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            # the consumer went away, e.g. client disconnected, stop decoding
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if kv_cache is not None:
+                y_pred = kv_cache.forward_chunk(self.llm, lm_input, offset=offset, att_mask=att_mask)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+                if hasattr(self.llm, 'forward_chunk_inplace'):
+                    kv_cache = KVCache(att_cache, max_len=att_cache.size(2) + max_len)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+            next_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+            top_ids = next_ids.item()
             if top_ids == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
             yield top_ids
-            out_tokens.append(top_ids)
+            out_tokens.append(next_ids)
             offset += lm_input.size(1)
-            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            lm_input = self.speech_embedding.weight[next_ids].reshape(1, 1, -1)
+            att_mask = step_att_mask
@@ -0,0 +1,233 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Continuous batching of speech token decoding across concurrent requests."""
+import atexit
+import logging
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Generator, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from cosyvoice.utils.common import TokenRingBuffer
+
+
+class _LLMSession:
+    """Decoding state of one request inside ContinuousBatchScheduler."""
+
+    def __init__(self, lm_input: torch.Tensor, min_len: int, max_len: int, sampling: int,
+                 cancel_event: Optional[threading.Event] = None):
+        self.lm_input = lm_input
+        self.min_len = min_len
+        self.max_len = max_len
+        self.sampling = sampling
+        self.num_tokens = 0
+        self.output = queue.Queue()
+        # set when the consumer of inference goes away, the session is retired at the next step
+        self.cancelled = False
+        self.cancel_event = cancel_event
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled or (self.cancel_event is not None and self.cancel_event.is_set())
+
+
+class ContinuousBatchScheduler:
+    """Decode speech tokens of all active requests in one batch.
+
+    New sessions are admitted and finished sessions are retired at every
+    decode step. Admitted sessions are prefilled one by one with batch size
+    1, then all active sessions share a single batched `forward_chunk` per
+    step. Per-session kv caches are left padded to the same length and the
+    padded positions are masked out, which keeps the relative positions
+    between the query and the real keys unchanged, so batching requires a
+    relative positional encoding (rel_pos_espnet in all released configs).
+
+    Args:
+        llm (torch.nn.Module): TransformerLM instance.
+        max_batch_size (int): max number of sessions decoded together.
+        llm_context: context manager entered by the decoding thread, e.g. a
+            dedicated cuda stream.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 8, llm_context=None):
+        assert max_batch_size >= 1
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.llm_context = llm_context if llm_context is not None else nullcontext()
+        self.pending = queue.Queue()
+        self.sessions: List[_LLMSession] = []
+        # batch state, att_cache (elayers, b, head, t, d_k * 2), att_valid (b, t),
+        # decoded keeps the latest tokens of every session on device for sampling
+        self.att_cache = None
+        self.att_valid = None
+        self.lm_input = None
+        self.decoded = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # stop the decoding thread before interpreter shutdown tears it down in the middle of a step
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+
+    def inference(self, text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len, embedding,
+                  sampling: int = 25, max_token_text_ratio: float = 20, min_token_text_ratio: float = 2,
+                  cancel_event: Optional[threading.Event] = None) -> Generator[int, None, None]:
+        """Same interface as TransformerLM.inference, decoding is done by the scheduler thread."""
+        with torch.inference_mode():
+            lm_input, min_len, max_len = self.llm.prepare_lm_input(text, text_len, prompt_text, prompt_text_len,
+                                                                   prompt_speech_token, prompt_speech_token_len, embedding,
+                                                                   max_token_text_ratio=max_token_text_ratio,
+                                                                   min_token_text_ratio=min_token_text_ratio)
+        session = _LLMSession(lm_input, min_len, max_len, sampling, cancel_event=cancel_event)
+        self.pending.put(session)
+        try:
+            while True:
+                token = session.output.get()
+                if token is None:
+                    break
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            session.cancelled = True
+
+    def _run(self):
+        with self.llm_context, torch.inference_mode():
+            while self.running:
+                try:
+                    self._admit()
+                    if len(self.sessions) != 0:
+                        self._step()
+                except Exception as e:
+                    logging.exception('llm scheduler failed to decode batch')
+                    self._abort(e)
+            self._abort(RuntimeError('llm scheduler is stopped'))
+
+    def _abort(self, e: Exception):
+        for session in self.sessions:
+            session.output.put(e)
+        self.sessions, self.att_cache, self.att_valid, self.lm_input, self.decoded = [], None, None, None, None
+
+    def _admit(self):
+        block = len(self.sessions) == 0
+        while len(self.sessions) < self.max_batch_size:
+            try:
+                session = self.pending.get(block=block)
+            except queue.Empty:
+                break
+            if session is None:
+                self.running = False
+                break
+            block = False
+            if session.is_cancelled():
+                session.output.put(None)
+                continue
+            try:
+                self._prefill(session)
+            except Exception as e:
+                logging.exception('llm scheduler failed to prefill session')
+                session.output.put(e)
+
+    def _prefill(self, session: _LLMSession):
+        lm_input = session.lm_input
+        y_pred, att_cache, _ = self.llm.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                                          att_cache=torch.zeros((0, 0, 0, 0), device=lm_input.device),
+                                                          cnn_cache=torch.zeros((0, 0, 0, 0), device=lm_input.device),
+                                                          att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                         device=lm_input.device)).to(torch.bool))
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        decoded = TokenRingBuffer(device=lm_input.device)
+        next_ids = self.llm.sampling_ids(logp, decoded, session.sampling, ignore_eos=session.min_len > 0)
+        if not self._accept(session, next_ids.item()):
+            return
+        decoded.append(next_ids)
+        # (elayers, head, t, d_k * 2) -> (elayers, 1, head, t, d_k * 2)
+        att_cache = att_cache.unsqueeze(dim=1)
+        att_valid = torch.ones((1, att_cache.size(3)), dtype=torch.bool, device=att_cache.device)
+        next_input = self.llm.speech_embedding.weight[next_ids]
+        if len(self.sessions) == 0:
+            self.att_cache, self.att_valid, self.lm_input, self.decoded = att_cache, att_valid, next_input, decoded
+        else:
+            # left pad the shorter cache so that all sessions end at the same position
+            diff = self.att_cache.size(3) - att_cache.size(3)
+            if diff > 0:
+                att_cache = F.pad(att_cache, (0, 0, diff, 0))
+                att_valid = F.pad(att_valid, (diff, 0), value=False)
+            elif diff < 0:
+                self.att_cache = F.pad(self.att_cache, (0, 0, -diff, 0))
+                self.att_valid = F.pad(self.att_valid, (-diff, 0), value=False)
+            self.att_cache = torch.concat([self.att_cache, att_cache], dim=1)
+            self.att_valid = torch.concat([self.att_valid, att_valid], dim=0)
+            self.lm_input = torch.concat([self.lm_input, next_input], dim=0)
+            self.decoded.extend(decoded)
+        self.sessions.append(session)
+
+    def _step(self):
+        elayers, batch_size = self.att_cache.size(0), self.att_cache.size(1)
+        att_cache = self.att_cache.reshape(elayers * batch_size, *self.att_cache.shape[2:])
+        att_valid = F.pad(self.att_valid, (0, 1), value=True)
+        y_pred, att_cache, _ = self.llm.llm.forward_chunk(self.lm_input, offset=self.att_valid.size(1), required_cache_size=-1,
+                                                          att_cache=att_cache,
+                                                          cnn_cache=torch.zeros((0, 0, 0, 0), device=att_cache.device),
+                                                          att_mask=att_valid.unsqueeze(dim=1))
+        self.att_cache = att_cache.reshape(elayers, batch_size, *att_cache.shape[1:])
+        self.att_valid = att_valid
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        # sample all sessions in one pass, only the sampled ids are copied to host
+        ignore_eos = torch.tensor([s.num_tokens < s.min_len for s in self.sessions], device=logp.device)
+        next_ids = self.llm.sampling_ids(logp, self.decoded, [s.sampling for s in self.sessions], ignore_eos=ignore_eos)
+        self.decoded.append(next_ids)
+        keep = [i for i, (session, top_ids) in enumerate(zip(self.sessions, next_ids.squeeze(dim=1).tolist()))
+                if self._accept(session, top_ids)]
+        if len(keep) != batch_size:
+            self._retire(keep)
+            next_ids = next_ids[keep]
+        if len(self.sessions) != 0:
+            self.lm_input = self.llm.speech_embedding.weight[next_ids]
+
+    def _accept(self, session: _LLMSession, top_ids: int) -> bool:
+        """Emit the sampled token of session, return False if the session is finished."""
+        if session.is_cancelled():
+            session.output.put(None)
+            return False
+        if top_ids == self.llm.speech_token_size:
+            session.output.put(None)
+            return False
+        session.output.put(top_ids)
+        session.num_tokens += 1
+        if session.num_tokens >= session.max_len:
+            session.output.put(None)
+            return False
+        return True
+
+    def _retire(self, keep: List[int]):
+        self.sessions = [self.sessions[i] for i in keep]
+        if len(keep) == 0:
+            self.att_cache, self.att_valid, self.lm_input, self.decoded = None, None, None, None
+            return
+        index = torch.tensor(keep, device=self.att_cache.device)
+        self.att_cache = self.att_cache.index_select(1, index)
+        self.att_valid = self.att_valid.index_select(0, index)
+        self.decoded.select(index)
+        # drop the leading positions which are padding for every remaining session
+        start = int(self.att_valid.any(dim=0).int().argmax())
+        if start > 0:
+            self.att_cache = self.att_cache[:, :, :, start:]
+            self.att_valid = self.att_valid[:, start:]
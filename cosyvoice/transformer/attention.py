@@ -17,10 +17,11 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 
 class MultiHeadedAttention(nn.Module):
@@ -49,6 +50,10 @@ class MultiHeadedAttention(nn.Module):
         self.linear_v = nn.Linear(n_feat, n_feat)
         self.linear_out = nn.Linear(n_feat, n_feat)
         self.dropout = nn.Dropout(p=dropout_rate)
+        # NOTE: fused sdpa kernel is only used in inference, a fully
+        #   masked row gives nan instead of 0 in some sdpa backends, training
+        #   keeps the explicit softmax path so that its numeric is unchanged.
+        self.use_sdpa = hasattr(F, 'scaled_dot_product_attention')
 
     def forward_qkv(
         self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor
@@ -126,6 +131,49 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_fused_attention(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Compute attention context vector by the fused
+        scaled_dot_product_attention kernel, same result as forward_attention
+        with scores = query @ key^T / sqrt(d_k) + bias.
+
+        Args:
+            query (torch.Tensor): Transformed query, size
+                (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size
+                (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size
+                (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor): Optional additive attention bias, size
+                (#batch, n_head, time1, time2).
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model).
+
+        """
+        n_batch = value.size(0)
+        attn_mask = bias
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1)[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            if attn_mask is None:
+                attn_mask = mask
+            else:
+                attn_mask = attn_mask.masked_fill(~mask, -float('inf'))
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)  # (batch, head, time1, d_k)
+        x = (x.transpose(1, 2).contiguous().view(n_batch, -1,
+                                                 self.h * self.d_k)
+             )  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
     def forward(
         self,
         query: torch.Tensor,
@@ -193,9 +241,59 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        if self.use_sdpa and not self.training:
+            return self.forward_fused_attention(q, k, v, mask), new_cache
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
+    def write_cache(
+        self, k: torch.Tensor, v: torch.Tensor, cache: torch.Tensor, cache_len: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write key and value into a preallocated cache in place.
+
+        Args:
+            k (torch.Tensor): Transformed key tensor (#batch, head, time2, d_k).
+            v (torch.Tensor): Transformed value tensor (#batch, head, time2, d_k).
+            cache (torch.Tensor): Preallocated cache tensor
+                (#batch, head, max_len, d_k * 2), positions [0, cache_len)
+                hold the key & value of previous chunks.
+            cache_len (int): Number of valid positions in cache.
+
+        Returns:
+            torch.Tensor: Key tensor (#batch, head, cache_len + time2, d_k).
+            torch.Tensor: Value tensor (#batch, head, cache_len + time2, d_k).
+
+        """
+        end = cache_len + k.size(2)
+        cache[:, :, cache_len:end, :self.d_k] = k
+        cache[:, :, cache_len:end, self.d_k:] = v
+        return cache[:, :, :end, :self.d_k], cache[:, :, :end, self.d_k:]
+
+    def forward_inplace(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cache: torch.Tensor,
+        cache_len: int,
+    ) -> torch.Tensor:
+        """Same as forward, but key & value of this chunk are written into a
+        preallocated cache (#batch, head, max_len, d_k * 2) at cache_len
+        instead of being concatenated to a new cache tensor.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(query, key, value)
+        k, v = self.write_cache(k, v, cache, cache_len)
+        if self.use_sdpa and not self.training:
+            return self.forward_fused_attention(q, k, v, mask)
+        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+        return self.forward_attention(v, scores, mask)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -301,30 +399,95 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
+        return self.forward_rel_attention(q, k, v, mask, pos_emb), new_cache
 
-        n_batch_pos = pos_emb.size(0)
-        p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
-        p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+    def forward_inplace(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cache: torch.Tensor,
+        cache_len: int,
+    ) -> torch.Tensor:
+        """Same as forward, but key & value of this chunk are written into a
+        preallocated cache (#batch, head, max_len, d_k * 2) at cache_len
+        instead of being concatenated to a new cache tensor.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(query, key, value)
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        k, v = self.write_cache(k, v, cache, cache_len)
+        return self.forward_rel_attention(q, k, v, mask, pos_emb)
+
+    def forward_rel_attention(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+    ) -> torch.Tensor:
+        """Compute attention with rel. positional encoding.
 
+        Args:
+            q (torch.Tensor): Query tensor (#batch, time1, head, d_k).
+            k (torch.Tensor): Key tensor (#batch, head, time2, d_k).
+            v (torch.Tensor): Value tensor (#batch, head, time2, d_k).
+            mask (torch.Tensor): Mask tensor (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): Positional embedding tensor
+                (#batch, time2, size).
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        # NOTE: for a single query, rel_shift only keeps the first
+        #   time2 positions of espnet rel_pos_emb, so slice pos_emb before
+        #   matrix bd instead of computing and shifting all 2*time2-1 positions
+        if q.size(1) == 1:
+            pos_emb = pos_emb[:, :k.size(2)]
         # (batch, head, time1, d_k)
         q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
         # (batch, head, time1, d_k)
         q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
 
         # compute attention score
-        # first compute matrix a and matrix c
-        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-        # (batch, head, time1, time2)
-        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
-
         # compute matrix b and matrix d
+        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
         # (batch, head, time1, time2)
-        matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+        # NOTE: projecting pos_emb costs O(time2 * size^2), when
+        #   time1 < d_k, e.g. step by step decoding, it is much cheaper to
+        #   project the query by linear_pos.weight first, which costs
+        #   O(time1 * time2 * size * head) and gives the same result.
+        if q_with_bias_v.size(2) < self.d_k:
+            weight = self.linear_pos.weight.view(self.h, self.d_k, -1)
+            # (batch, head, time1, size)
+            q_with_bias_v = torch.matmul(q_with_bias_v, weight)
+            matrix_bd = torch.matmul(q_with_bias_v, pos_emb.transpose(-2, -1).unsqueeze(1))
+        else:
+            n_batch_pos = pos_emb.size(0)
+            p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+            p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+            matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
         # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
-        if matrix_ac.shape != matrix_bd.shape:
+        if matrix_bd.size(-1) != k.size(2):
             matrix_bd = self.rel_shift(matrix_bd)
 
+        if self.use_sdpa and not self.training:
+            # matrix a and matrix c are computed by the fused kernel,
+            # matrix b and matrix d are added as attention bias
+            return self.forward_fused_attention(q_with_bias_u, k, v, mask, matrix_bd / math.sqrt(self.d_k))
+
+        # then compute matrix a and matrix c
+        # (batch, head, time1, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
-        return self.forward_attention(v, scores, mask), new_cache
+        return self.forward_attention(v, scores, mask)
@@ -193,7 +193,7 @@ class BaseEncoder(torch.nn.Module):
         """ Forward just one chunk
 
         Args:
-            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim),
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim),
                 where `time == (chunk_size - 1) * subsample_rate + \
                         subsample.right_context + 1`
             offset (int): current offset in encoder output time stamp
@@ -203,36 +203,43 @@ class BaseEncoder(torch.nn.Module):
                 <0: means all history cache is required
             att_cache (torch.Tensor): cache tensor for KEY & VALUE in
                 transformer/conformer attention, with shape
-                (elayers, head, cache_t1, d_k * 2), where
+                (elayers * b, head, cache_t1, d_k * 2), where
                 `head * d_k == hidden-dim` and
                 `cache_t1 == chunk_size * num_decoding_left_chunks`.
+                Rows are layer major, i.e. rows [i * b, (i + 1) * b) hold
+                the cache of the i-th layer, so b=1 is the usual
+                (elayers, head, cache_t1, d_k * 2) layout.
             cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
-                (elayers, b=1, hidden-dim, cache_t2), where
+                (elayers, b, hidden-dim, cache_t2), where
                 `cache_t2 == cnn.lorder - 1`
+            att_mask (torch.Tensor): mask tensor (b, time, cache_t1 + time)
+                or (b, 1, cache_t1 + time), (0, 0, 0) means fake mask. When
+                b > 1 the caches are usually left padded to the same
+                cache_t1 and the padded positions must be masked out here.
 
         Returns:
             torch.Tensor: output of current input xs,
-                with shape (b=1, chunk_size, hidden-dim).
+                with shape (b, chunk_size, hidden-dim).
             torch.Tensor: new attention cache required for next chunk, with
-                dynamic shape (elayers, head, ?, d_k * 2)
+                dynamic shape (elayers * b, head, ?, d_k * 2)
                 depending on required_cache_size.
             torch.Tensor: new conformer cnn cache required for next chunk, with
                 same shape as the original cnn_cache.
 
         """
-        assert xs.size(0) == 1
+        batch_size = xs.size(0)
         # tmp_masks is just for interface compatibility
-        tmp_masks = torch.ones(1,
+        tmp_masks = torch.ones(batch_size,
                                xs.size(1),
                                device=xs.device,
                                dtype=torch.bool)
         tmp_masks = tmp_masks.unsqueeze(1)
         if self.global_cmvn is not None:
             xs = self.global_cmvn(xs)
-        # NOTE(xcsong): Before embed, shape(xs) is (b=1, time, mel-dim)
+        # NOTE(xcsong): Before embed, shape(xs) is (b, time, mel-dim)
         xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
-        # NOTE(xcsong): After  embed, shape(xs) is (b=1, chunk_size, hidden-dim)
-        elayers, cache_t1 = att_cache.size(0), att_cache.size(2)
+        # NOTE(xcsong): After  embed, shape(xs) is (b, chunk_size, hidden-dim)
+        elayers, cache_t1 = att_cache.size(0) // batch_size, att_cache.size(2)
         chunk_size = xs.size(1)
         attention_key_size = cache_t1 + chunk_size
         pos_emb = self.embed.position_encoding(offset=offset - cache_t1,
@@ -247,26 +254,26 @@ class BaseEncoder(torch.nn.Module):
         r_cnn_cache = []
         for i, layer in enumerate(self.encoders):
             # NOTE(xcsong): Before layer.forward
-            #   shape(att_cache[i:i + 1]) is (1, head, cache_t1, d_k * 2),
-            #   shape(cnn_cache[i])       is (b=1, hidden-dim, cache_t2)
+            #   shape(att_cache[i * b:(i + 1) * b]) is (b, head, cache_t1, d_k * 2),
+            #   shape(cnn_cache[i])                 is (b, hidden-dim, cache_t2)
             xs, _, new_att_cache, new_cnn_cache = layer(
                 xs,
                 att_mask,
                 pos_emb,
-                att_cache=att_cache[i:i + 1] if elayers > 0 else att_cache,
+                att_cache=att_cache[i * batch_size:(i + 1) * batch_size] if elayers > 0 else att_cache,
                 cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache)
             # NOTE(xcsong): After layer.forward
-            #   shape(new_att_cache) is (1, head, attention_key_size, d_k * 2),
-            #   shape(new_cnn_cache) is (b=1, hidden-dim, cache_t2)
+            #   shape(new_att_cache) is (b, head, attention_key_size, d_k * 2),
+            #   shape(new_cnn_cache) is (b, hidden-dim, cache_t2)
             r_att_cache.append(new_att_cache[:, :, next_cache_start:, :])
             r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
         if self.normalize_before:
             xs = self.after_norm(xs)
 
-        # NOTE(xcsong): shape(r_att_cache) is (elayers, head, ?, d_k * 2),
+        # NOTE(xcsong): shape(r_att_cache) is (elayers * b, head, ?, d_k * 2),
         #   ? may be larger than cache_t1, it depends on required_cache_size
         r_att_cache = torch.cat(r_att_cache, dim=0)
-        # NOTE(xcsong): shape(r_cnn_cache) is (e, b=1, hidden-dim, cache_t2)
+        # NOTE(xcsong): shape(r_cnn_cache) is (e, b, hidden-dim, cache_t2)
         r_cnn_cache = torch.cat(r_cnn_cache, dim=0)
 
         return (xs, r_att_cache, r_cnn_cache)
@@ -383,6 +390,61 @@ class TransformerEncoder(BaseEncoder):
                 dropout_rate, normalize_before) for _ in range(num_blocks)
         ])
 
+    @torch.jit.export
+    def forward_chunk_inplace(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        cache_len: int,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward just one chunk with a preallocated attention cache
+
+        Unlike forward_chunk, the KEY & VALUE of this chunk are written into
+        att_cache in place, so no new cache tensor is built per chunk and
+        the memory traffic per step does not grow with the cache length.
+        See cosyvoice.transformer.kv_cache.KVCache.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim).
+            offset (int): current offset in encoder output time stamp
+            att_cache (torch.Tensor): preallocated cache tensor for KEY &
+                VALUE, with shape (elayers * b, head, max_len, d_k * 2),
+                layer major as in forward_chunk. Positions
+                [0, cache_len) hold previous chunks, this chunk is written
+                to [cache_len, cache_len + time).
+            cache_len (int): number of valid positions in att_cache.
+            att_mask (torch.Tensor): mask tensor
+                (b, time, cache_len + time), (0, 0, 0) means fake mask.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, chunk_size, hidden-dim).
+
+        """
+        batch_size = xs.size(0)
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(batch_size,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        tmp_masks = tmp_masks.unsqueeze(1)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        attention_key_size = cache_len + xs.size(1)
+        assert attention_key_size <= att_cache.size(2)
+        pos_emb = self.embed.position_encoding(offset=offset - cache_len,
+                                               size=attention_key_size)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_inplace(xs, att_mask, pos_emb,
+                                       att_cache[i * batch_size:(i + 1) * batch_size],
+                                       cache_len)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
 
 class ConformerEncoder(BaseEncoder):
     """Conformer encoder module."""
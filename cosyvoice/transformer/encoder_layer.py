@@ -105,6 +105,45 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    def forward_inplace(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        att_cache: torch.Tensor,
+        cache_len: int,
+    ) -> torch.Tensor:
+        """Compute encoded features with a preallocated attention cache.
+
+        Args:
+            x (torch.Tensor): (#batch, time, size)
+            mask (torch.Tensor): Mask tensor for the input
+                (#batch, time, cache_len + time), (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): positional encoding.
+            att_cache (torch.Tensor): Preallocated cache tensor of the KEY &
+                VALUE (#batch, head, max_len, d_k * 2), the KEY & VALUE of x
+                are written to [cache_len, cache_len + time) in place.
+            cache_len (int): number of valid positions in att_cache.
+        Returns:
+            torch.Tensor: Output tensor (#batch, time, size).
+
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x_att = self.self_attn.forward_inplace(x, x, x, mask, pos_emb, att_cache, cache_len)
+        x = residual + self.dropout(x_att)
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
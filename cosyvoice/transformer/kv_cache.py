@@ -0,0 +1,63 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Preallocated attention cache for step by step decoding."""
+
+import torch
+
+
+class KVCache:
+    """Preallocated, growable KEY & VALUE cache of one decoding session.
+
+    The storage has the same (elayers * b, head, max_len, d_k * 2) layout as
+    the att_cache of BaseEncoder.forward_chunk, but is allocated once and
+    written in place by TransformerEncoder.forward_chunk_inplace. When a
+    chunk does not fit, the capacity is doubled, so the amortized cost of
+    each step does not depend on the decoded length.
+
+    Args:
+        att_cache (torch.Tensor): initial cache, e.g. the cache returned by
+            forward_chunk for the prefill, (elayers * b, head, t, d_k * 2).
+        max_len (int): initial capacity, at least t.
+    """
+
+    def __init__(self, att_cache: torch.Tensor, max_len: int = 0):
+        self.length = att_cache.size(2)
+        capacity = max(max_len, self.length, 1)
+        self.cache = att_cache.new_zeros(att_cache.size(0), att_cache.size(1), capacity, att_cache.size(3))
+        self.cache[:, :, :self.length] = att_cache
+
+    @property
+    def capacity(self) -> int:
+        return self.cache.size(2)
+
+    def reserve(self, size: int):
+        """Make sure another size positions fit into the cache."""
+        if self.length + size <= self.capacity:
+            return
+        capacity = max(self.length + size, 2 * self.capacity)
+        cache = self.cache.new_zeros(self.cache.size(0), self.cache.size(1), capacity, self.cache.size(3))
+        cache[:, :, :self.length] = self.cache[:, :, :self.length]
+        self.cache = cache
+
+    def forward_chunk(self, encoder: torch.nn.Module, xs: torch.Tensor, offset: int,
+                      att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool)) -> torch.Tensor:
+        """Run encoder.forward_chunk_inplace on xs and advance the cache."""
+        self.reserve(xs.size(1))
+        ys = encoder.forward_chunk_inplace(xs, offset, self.cache, self.length, att_mask)
+        self.length += xs.size(1)
+        return ys
+
+    def view(self) -> torch.Tensor:
+        """Valid part of the cache, same as the att_cache of forward_chunk."""
+        return self.cache[:, :, :self.length]
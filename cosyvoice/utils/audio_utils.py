@@ -0,0 +1,146 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+import torchaudio
+import torchaudio.compliance.kaldi as kaldi
+
+# resamplers shared by the whole process, building one computes its sinc kernel
+_resamplers: Dict[Tuple[int, int, torch.device, torch.dtype], torchaudio.transforms.Resample] = {}
+_resamplers_lock = threading.Lock()
+
+
+def get_resampler(orig_freq: int, new_freq: int, device: torch.device = torch.device('cpu'),
+                  dtype: torch.dtype = torch.float32) -> torchaudio.transforms.Resample:
+    """Return the shared resampler of (orig_freq, new_freq, device, dtype), build it on first use.
+
+    The resampler only reads its kernel in forward, so it can be used by
+    several threads at the same time.
+    """
+    key = (int(orig_freq), int(new_freq), torch.device(device), dtype)
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        with _resamplers_lock:
+            resampler = _resamplers.get(key)
+            if resampler is None:
+                # the kernel is computed in float64 and then cast, same as a resampler built without dtype
+                resampler = torchaudio.transforms.Resample(orig_freq=int(orig_freq), new_freq=int(new_freq)).to(device=device, dtype=dtype)
+                _resamplers[key] = resampler
+    return resampler
+
+
+def resample(waveform: torch.Tensor, orig_freq: int, new_freq: int) -> torch.Tensor:
+    """Same as torchaudio.transforms.Resample(orig_freq, new_freq)(waveform) with a cached kernel."""
+    if orig_freq == new_freq:
+        return waveform
+    return get_resampler(orig_freq, new_freq, waveform.device, waveform.dtype)(waveform)
+
+
+def resample_batch(waveforms: List[torch.Tensor], orig_freq: int, new_freq: int) -> List[torch.Tensor]:
+    """Resample waveforms of the same sample rate with one convolution.
+
+    The waveforms are right padded with zeros to the longest one, which is
+    what the resampler does at the end of every waveform anyway, so each
+    result equals resample(waveform, orig_freq, new_freq).
+
+    Args:
+        waveforms: list of (..., time) tensors, all leading dims must match.
+
+    Returns:
+        list of (..., new_time) tensors.
+    """
+    if orig_freq == new_freq or len(waveforms) == 0:
+        return waveforms
+    lengths = [w.size(-1) for w in waveforms]
+    max_len = max(lengths)
+    batch = torch.stack([F.pad(w, (0, max_len - w.size(-1))) for w in waveforms], dim=0)
+    batch = resample(batch, orig_freq, new_freq)
+    return [batch[i, ..., :-(-new_freq * length // orig_freq)] for i, length in enumerate(lengths)]
+
+
+# windows and mel bases of the feature extractors below, keyed by (name, device, dtype)
+_feature_tensors: Dict[Tuple[str, torch.device, torch.dtype], torch.Tensor] = {}
+
+
+def _feature_tensor(name: str, device: torch.device, dtype: torch.dtype, build) -> torch.Tensor:
+    key = (name, torch.device(device), dtype)
+    tensor = _feature_tensors.get(key)
+    if tensor is None:
+        tensor = _feature_tensors.setdefault(key, build().to(device=device, dtype=dtype))
+    return tensor
+
+
+def _pad_batch(waveforms: List[torch.Tensor]) -> torch.Tensor:
+    max_len = max(w.size(-1) for w in waveforms)
+    return torch.stack([F.pad(w, (0, max_len - w.size(-1))) for w in waveforms], dim=0)
+
+
+def kaldi_fbank_batch(waveforms: List[torch.Tensor], num_mel_bins: int = 80, sample_frequency: int = 16000) -> List[torch.Tensor]:
+    """Batched torchaudio.compliance.kaldi.fbank(waveform, num_mel_bins, dither=0, sample_frequency) of 1d waveforms.
+
+    Frames of the kaldi fbank never cross the end of a waveform, so the
+    waveforms are zero padded to the longest one, framed and transformed in
+    one batch and the frames of the padding are dropped. The povey window and
+    the mel banks are built once per device and dtype.
+
+    Returns:
+        list of (frames, num_mel_bins) features, empty for waveforms shorter than a frame.
+    """
+    window_size, window_shift, padded_window_size = int(sample_frequency * 0.025), int(sample_frequency * 0.01), 512
+    lengths = [w.size(-1) for w in waveforms]
+    batch = _pad_batch(waveforms)
+    if batch.size(-1) < window_size:
+        return [batch.new_zeros(0, num_mel_bins) for _ in waveforms]
+    device, dtype = batch.device, batch.dtype
+    frames = batch.unfold(-1, window_size, window_shift)
+    frames = frames - frames.mean(dim=-1, keepdim=True)
+    frames = frames - 0.97 * F.pad(frames, (1, 0), mode='replicate')[..., :-1]
+    window = _feature_tensor('povey_{}'.format(window_size), device, dtype,
+                             lambda: torch.hann_window(window_size, periodic=False, dtype=dtype).pow(0.85))
+    frames = F.pad(frames * window, (0, padded_window_size - window_size))
+    spectrum = torch.fft.rfft(frames).abs().pow(2.0)
+    mel_banks = _feature_tensor('kaldi_mel_{}_{}_{}'.format(num_mel_bins, padded_window_size, sample_frequency), device, dtype,
+                                lambda: F.pad(kaldi.get_mel_banks(num_mel_bins, padded_window_size, float(sample_frequency),
+                                                                  20.0, 0.0, 100.0, -500.0, 1.0)[0], (0, 1)).T)
+    fbank = torch.max(spectrum @ mel_banks, torch.tensor(torch.finfo(dtype).eps, device=device, dtype=dtype)).log()
+    return [fbank[i, :max(0, 1 + (length - window_size) // window_shift)] for i, length in enumerate(lengths)]
+
+
+def whisper_log_mel_batch(waveforms: List[torch.Tensor], n_mels: int = 128) -> List[torch.Tensor]:
+    """Batched whisper.log_mel_spectrogram(waveform, n_mels) of 1d 16k waveforms.
+
+    Every waveform is reflect padded on its own before the batch is zero
+    padded, so the edge frames match the unbatched stft, and the dynamic
+    range is clamped per waveform. The hann window is built once per device.
+
+    Returns:
+        list of (n_mels, frames) features.
+    """
+    from whisper.audio import mel_filters
+    n_fft, hop_length = 400, 160
+    lengths = [w.size(-1) for w in waveforms]
+    batch = _pad_batch([F.pad(w.view(1, -1), (n_fft // 2, n_fft // 2), mode='reflect')[0] for w in waveforms])
+    window = _feature_tensor('hann_{}'.format(n_fft), batch.device, batch.dtype, lambda: torch.hann_window(n_fft))
+    stft = torch.stft(batch, n_fft, hop_length, window=window, center=False, return_complex=True)
+    mel_spec = mel_filters(batch.device, n_mels) @ (stft.abs() ** 2)
+    log_specs = []
+    for i, length in enumerate(lengths):
+        # whisper drops the frame centered on the last sample
+        log_spec = torch.clamp(mel_spec[i, :, :length // hop_length], min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        log_specs.append((log_spec + 4.0) / 4.0)
+    return log_specs
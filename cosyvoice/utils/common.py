@@ -15,8 +15,10 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Unility functions for Transformer."""
 
+import logging
+import os
 import random
-from typing import List
+from typing import Dict, List, Tuple
 
 import numpy as np
 import torch
@@ -105,45 +107,114 @@ def init_weights(m, mean=0.0, std=0.01):
         m.weight.data.normal_(mean, std)
 
 
+class TokenRingBuffer:
+    """Device side ring buffer of the latest decoded tokens.
+
+    Keeps the last `capacity` tokens of each of `batch_size` sessions on
+    device, so that repetition aware sampling does not build a new tensor
+    from a python list at every decoding step.
+
+    Args:
+        capacity (int): max number of latest tokens kept per session.
+        batch_size (int): number of sessions.
+        device (torch.device): device of the buffer.
+    """
+
+    def __init__(self, capacity: int = 64, batch_size: int = 1, device: torch.device = None):
+        self.buffer = torch.full((batch_size, capacity), IGNORE_ID, dtype=torch.long, device=device)
+        self.length = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    @property
+    def capacity(self) -> int:
+        return self.buffer.size(1)
+
+    def append(self, tokens: torch.Tensor):
+        """Append one token per session, tokens (batch_size,) or (batch_size, 1)."""
+        rows = torch.arange(self.buffer.size(0), device=self.buffer.device)
+        self.buffer[rows, self.length % self.capacity] = tokens.reshape(-1).to(self.buffer)
+        self.length += 1
+
+    def window(self, size: int) -> torch.Tensor:
+        """Latest size tokens of each session in decoding order, (batch_size, size),
+        positions before the first decoded token are IGNORE_ID."""
+        if size > self.capacity:
+            raise ValueError('window size {} is larger than ring buffer capacity {}'.format(size, self.capacity))
+        steps = torch.arange(size, device=self.buffer.device)
+        index = (self.length.unsqueeze(1) - size + steps) % self.capacity
+        window = self.buffer.gather(1, index)
+        return window.masked_fill(steps < size - self.length.unsqueeze(1), IGNORE_ID)
+
+    def select(self, index: torch.Tensor):
+        """Keep the sessions in index, in that order."""
+        self.buffer = self.buffer.index_select(0, index)
+        self.length = self.length.index_select(0, index)
+
+    def extend(self, other: 'TokenRingBuffer'):
+        """Append the sessions of other, which has the same capacity."""
+        self.buffer = torch.concat([self.buffer, other.buffer], dim=0)
+        self.length = torch.concat([self.length, other.length], dim=0)
+
+
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    if isinstance(decoded_tokens, TokenRingBuffer):
+        window = decoded_tokens.window(win_size)
+    else:
+        window = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=weighted_scores.device).reshape(1, -1)
+    rep_num = (window == top_ids.reshape(window.size(0), 1)).sum(dim=-1).view_as(top_ids)
+    # both candidates are sampled on device, which avoids a host sync to decide on the fallback
+    random_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    top_ids = torch.where(rep_num >= win_size * tau_r, random_ids, top_ids)
     return top_ids
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+    prob, indices = weighted_scores.softmax(dim=-1).topk(min(top_k, weighted_scores.size(-1)), dim=-1)
+    # sampling both top-p and numbers, a token is kept if the probability of the tokens before it is below top_p
+    prob = prob.masked_fill(prob.cumsum(dim=-1) - prob >= top_p, 0)
+    top_ids = indices.gather(-1, prob.multinomial(1, replacement=True))
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
+# hamming windows of crossfade, keyed by (overlap_len, device, dtype)
+_fade_windows: Dict[Tuple[int, torch.device, torch.dtype], torch.Tensor] = {}
+
+
+def get_fade_window(overlap_len: int, device: torch.device, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """Return the cached (2 * overlap_len,) hamming window of crossfade on device, its first half fades in."""
+    key = (overlap_len, torch.device(device), dtype)
+    window = _fade_windows.get(key)
+    if window is None:
+        window = _fade_windows.setdefault(key, torch.from_numpy(np.hamming(2 * overlap_len)).to(device=device, dtype=dtype))
+    return window
+
+
+def crossfade(fade_in: torch.Tensor, fade_out: torch.Tensor, overlap_len: int) -> torch.Tensor:
+    """Overlap-add the head of fade_in with the tail of fade_out along the last dim, on their device.
+
+    The first overlap_len steps of fade_in are replaced by
+    fade_in * window[:overlap_len] + fade_out[-overlap_len:] * window[overlap_len:],
+    used for both mel (batch, mel, time) and speech (batch, time) chunks. A new
+    tensor is returned, fade_in is not modified.
+    """
+    window = get_fade_window(overlap_len, fade_in.device, fade_in.dtype)
+    head = torch.addcmul(fade_out[..., -overlap_len:] * window[overlap_len:], fade_in[..., :overlap_len], window[:overlap_len])
+    return torch.concat([head, fade_in[..., overlap_len:]], dim=-1)
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    """Same as crossfade with the given (2 * overlap_len,) window instead of the cached hamming one."""
     mel_overlap_len = int(window.shape[0] / 2)
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    window = window.to(device=fade_in_mel.device, dtype=fade_in_mel.dtype)
+    head = torch.addcmul(fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:],
+                         fade_in_mel[..., :mel_overlap_len], window[:mel_overlap_len])
+    return torch.concat([head, fade_in_mel[..., mel_overlap_len:]], dim=-1)
 
 
 def set_all_random_seed(seed):
@@ -151,3 +222,23 @@ def set_all_random_seed(seed):
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+
+
+def set_cpu_threads(num_threads: int = 0, num_interop_threads: int = 0, num_workers: int = 1) -> int:
+    """Set the torch intra-op and inter-op threads of this process, returns the intra-op threads.
+
+    num_threads 0 splits the cores this process may run on evenly among the
+    num_workers worker processes of the node, so that workers do not
+    oversubscribe the cores. num_interop_threads 0 keeps the torch default,
+    torch only accepts it before its first inter-op parallel work.
+    """
+    if num_threads == 0:
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        num_threads = max(1, num_cores // num_workers)
+    torch.set_num_threads(num_threads)
+    if num_interop_threads != 0 and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            logging.warning('inter-op threads are already in use, keep {} inter-op threads'.format(torch.get_num_interop_threads()))
+    return num_threads
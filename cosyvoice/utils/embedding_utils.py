@@ -0,0 +1,125 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import os
+from typing import Dict, List
+
+import numpy as np
+import onnxruntime
+import torch
+
+from cosyvoice.utils.audio_utils import kaldi_fbank_batch
+
+
+def compute_campplus_fbank(speech: torch.Tensor) -> torch.Tensor:
+    """Mean normalized 80 dim fbank of a (1, time) 16k waveform, the input of campplus.onnx."""
+    feat = kaldi_fbank_batch([speech[0]], num_mel_bins=80, sample_frequency=16000)[0]
+    return feat - feat.mean(dim=0, keepdim=True)
+
+
+def campplus_num_frames(num_samples: int, sample_rate: int) -> int:
+    """Number of fbank frames compute_campplus_fbank gives for num_samples at sample_rate, after resampling to 16k."""
+    num_samples = math.ceil(num_samples * 16000 / sample_rate)
+    return 1 + (num_samples - 400) // 160 if num_samples >= 400 else 0
+
+
+def extract_spk_embedding(ort_session: onnxruntime.InferenceSession, feats: List[torch.Tensor], pad: bool = False) -> np.ndarray:
+    """Extract speaker embeddings of a batch of fbank features.
+
+    campplus.onnx has no length input and ends with statistics pooling over
+    time, so any padding changes the embedding. By default features of equal
+    length share one ort run and every embedding is the one of its feature
+    alone, as extracted by the frontend at inference. pad=True runs all
+    features at once, shorter ones padded by repeating themselves, which is
+    faster but only close to the unpadded embeddings, batches should then only
+    hold features of similar length, see bucket_by_length.
+
+    Args:
+        feats: list of (time, 80) features.
+
+    Returns:
+        (batch, embedding_dim) embeddings.
+    """
+    if pad is True:
+        max_len = max(feat.shape[0] for feat in feats)
+        feats = [feat.repeat(-(-max_len // feat.shape[0]), 1)[:max_len] for feat in feats]
+        return ort_session.run(None, {ort_session.get_inputs()[0].name: torch.stack(feats, dim=0).cpu().numpy()})[0]
+    groups = {}
+    for i, feat in enumerate(feats):
+        groups.setdefault(feat.shape[0], []).append(i)
+    embeddings = [None] * len(feats)
+    for indices in groups.values():
+        outputs = ort_session.run(None, {ort_session.get_inputs()[0].name: torch.stack([feats[i] for i in indices], dim=0).cpu().numpy()})[0]
+        for i, output in zip(indices, outputs):
+            embeddings[i] = output
+    return np.stack(embeddings, axis=0)
+
+
+def bucket_by_length(lengths: List[int], batch_size: int = 32, max_pad_ratio: float = 1.1) -> List[List[int]]:
+    """Group indices of lengths into batches of at most batch_size, sorted by length.
+
+    The longest item of a batch is at most max_pad_ratio times longer than
+    the shortest one, max_pad_ratio 1.0 only batches items of equal length.
+    """
+    batches, batch = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if len(batch) != 0 and (len(batch) == batch_size or lengths[i] > lengths[batch[0]] * max_pad_ratio):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) != 0:
+        batches.append(batch)
+    return batches
+
+
+def create_embedding_table(prefix: str, keys: List[str], dim: int) -> np.ndarray:
+    """Create prefix.npy as a writable (len(keys), dim) float32 memmap and write keys, one per line in row order, to prefix.list."""
+    with open('{}.list'.format(prefix), 'w', encoding='utf8') as f:
+        for key in keys:
+            f.write(key + '\n')
+    return np.lib.format.open_memmap('{}.npy'.format(prefix), mode='w+', dtype=np.float32, shape=(len(keys), dim))
+
+
+class EmbeddingTable:
+    """Read only key to embedding mapping over prefix.npy and prefix.list.
+
+    The embeddings are memory mapped, so a table of millions of utterances
+    is opened instantly, costs little memory and is shared by forked workers.
+    Lookups return lists, same as the values of the legacy torch.save dicts.
+    """
+
+    def __init__(self, prefix: str):
+        self.embeddings = np.load('{}.npy'.format(prefix), mmap_mode='r')
+        with open('{}.list'.format(prefix), 'r', encoding='utf8') as f:
+            self.key2index: Dict[str, int] = {line.strip(): i for i, line in enumerate(f)}
+        assert self.embeddings.shape[0] == len(self.key2index)
+
+    def __getitem__(self, key: str) -> List[float]:
+        return self.embeddings[self.key2index[key]].tolist()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.key2index
+
+    def __len__(self) -> int:
+        return len(self.key2index)
+
+    def keys(self):
+        return self.key2index.keys()
+
+
+def load_embedding_table(prefix: str):
+    """Load prefix.npy/prefix.list written by create_embedding_table, or the legacy prefix.pt dict."""
+    if os.path.exists('{}.npy'.format(prefix)):
+        return EmbeddingTable(prefix)
+    return torch.load('{}.pt'.format(prefix))
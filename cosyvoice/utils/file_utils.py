@@ -16,6 +16,7 @@
 import json
 import torchaudio
 import logging
+from cosyvoice.utils.audio_utils import resample
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -43,5 +44,5 @@ def load_wav(wav, target_sr):
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
         assert sample_rate > target_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
-        speech = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=target_sr)(speech)
+        speech = resample(speech, sample_rate, target_sr)
     return speech
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import re
+from itertools import chain
+from typing import Generator, Iterable
 chinese_char_pattern = re.compile(r'[\u4e00-\u9fff]+')
 
 
@@ -61,6 +63,8 @@ def spell_out_number(text: str, inflect_parser):
 # 1. per sentence max len token_max_n, min len token_min_n, merge if last sentence len less than merge_len
 # 2. cal sentence len according to lang
 # 3. split sentence according to puncatation
+# every sentence is measured once, the len of merged sentences is the sum of their lens, for en this can
+# differ from tokenizing the merged text by a token at a sentence boundary, but avoids quadratic tokenizing
 def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
     def calc_utt_length(_text: str):
         if lang == "zh":
@@ -68,12 +72,6 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
         else:
             return len(tokenize(_text))
 
-    def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
-
     if lang == "zh":
         pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';']
     else:
@@ -101,14 +99,15 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
                 st = i + 1
 
     final_utts = []
-    cur_utt = ""
+    cur_utt, cur_len = "", 0
     for utt in utts:
-        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
+        utt_len = calc_utt_length(utt)
+        if cur_len + utt_len > token_max_n and cur_len > token_min_n:
             final_utts.append(cur_utt)
-            cur_utt = ""
-        cur_utt = cur_utt + utt
+            cur_utt, cur_len = "", 0
+        cur_utt, cur_len = cur_utt + utt, cur_len + utt_len
     if len(cur_utt) > 0:
-        if should_merge(cur_utt) and len(final_utts) != 0:
+        if cur_len < merge_len and len(final_utts) != 0:
             final_utts[-1] = final_utts[-1] + cur_utt
         else:
             final_utts.append(cur_utt)
@@ -116,6 +115,59 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
     return final_utts
 
 
+# streaming version of split_paragraph for text which arrives in fragments, e.g. from a llm streamer
+# 1. a sentence is cut as soon as its punctuation and the following char are seen, the following char
+#    keeps closing quotes in the sentence and does not cut decimal points
+# 2. the first sentence is yielded at once, and already at a comma once it is merge_len long,
+#    so that synthesis starts while the rest of the text is still generated
+# 3. following sentences are merged with the rules of split_paragraph, the last one is not merged backwards
+# segments are not normalized, lang is decided per sentence
+def split_paragraph_stream(fragments: Iterable[str], tokenize, token_max_n=80, token_min_n=60, merge_len=20) -> Generator[str, None, None]:
+    def calc_utt_length(_text: str):
+        if contains_chinese(_text):
+            return len(_text)
+        else:
+            return len(tokenize(_text))
+
+    pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';', ':']
+    comma = ['，', ',']
+
+    text, st, i = '', 0, 0
+    num_utts = 0
+    cur_utt, cur_len = "", 0
+    for fragment in chain(fragments, [None]):
+        if fragment is not None:
+            text += fragment
+        utts = []
+        end = len(text) if fragment is None else len(text) - 1
+        while i < end:
+            c, next_c = text[i], text[i + 1] if i + 1 < len(text) else ''
+            if (c in pounc and not (c == '.' and next_c.isdigit())) or \
+                    (num_utts + len(utts) == 0 and c in comma and calc_utt_length(text[st: i]) >= merge_len):
+                j = i + 2 if next_c in ['"', '”'] else i + 1
+                if len(text[st: i].strip()) > 0:
+                    utts.append(text[st: j])
+                st = i = j
+            else:
+                i += 1
+        if fragment is None and len(text[st:].strip()) > 0:
+            utts.append(text[st:])
+        text, i, st = text[st:], i - st, 0
+
+        for utt in utts:
+            utt_len = calc_utt_length(utt)
+            if num_utts == 0:
+                yield utt
+            elif cur_len + utt_len > token_max_n and cur_len > token_min_n:
+                yield cur_utt
+                cur_utt, cur_len = utt, utt_len
+            else:
+                cur_utt, cur_len = cur_utt + utt, cur_len + utt_len
+            num_utts += 1
+    if len(cur_utt) > 0:
+        yield cur_utt
+
+
 # remove blank between chinese character
 def replace_blank(text: str):
     out_str = []
@@ -0,0 +1,68 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+import torch
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+# Linear layers whose weight is read directly, e.g. RelPositionMultiHeadedAttention
+# multiplies the query by linear_pos.weight, they are kept in float
+FLOAT_LINEAR_NAMES = ('linear_pos',)
+
+
+def quantize_linear_dynamic(model: torch.nn.Module, names: List[str]) -> List[str]:
+    """Quantize the Linear layers inside the submodules names of model to dynamic int8 in place, cpu only.
+
+    Weights are stored as per channel int8 and activations are quantized per
+    batch at run time. Submodules which are not torch modules, e.g. jit or
+    onnxruntime models, are skipped.
+
+    Returns:
+        names of the quantized submodules.
+    """
+    qconfig_spec, quantized_names = {}, []
+    for name in names:
+        module = model
+        for attr in name.split('.'):
+            module = getattr(module, attr, None)
+        if not isinstance(module, torch.nn.Module) or isinstance(module, torch.jit.ScriptModule):
+            continue
+        # every Linear is listed by name, a qconfig on a parent would also reach its convolutions
+        for sub_name, sub_module in module.named_modules():
+            if type(sub_module) is torch.nn.Linear and sub_name.split('.')[-1] not in FLOAT_LINEAR_NAMES:
+                qconfig_spec[name if sub_name == '' else '{}.{}'.format(name, sub_name)] = per_channel_dynamic_qconfig
+        quantized_names.append(name)
+    if len(qconfig_spec) != 0:
+        quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+    return quantized_names
+
+
+def split_quantize_units(model: torch.nn.Module, names: List[str]) -> List[str]:
+    """Split the submodules names of model into units, which are quantized or kept in float as a whole.
+
+    An encoder with an encoders ModuleList gives one unit per layer and one per
+    other child holding Linear layers, e.g. embed, any other submodule is one unit.
+    """
+    units = []
+    for name in names:
+        module = model.get_submodule(name)
+        if not isinstance(getattr(module, 'encoders', None), torch.nn.ModuleList):
+            units.append(name)
+            continue
+        for child_name, child in module.named_children():
+            if child_name == 'encoders':
+                units += ['{}.encoders.{}'.format(name, i) for i in range(len(child))]
+            elif any(type(m) is torch.nn.Linear for m in child.modules()):
+                units.append('{}.{}'.format(name, child_name))
+    return units
@@ -0,0 +1,166 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import os
+from typing import Dict, List
+
+import numpy as np
+import onnxruntime
+import torch
+import torch.nn.functional as F
+
+from cosyvoice.utils.audio_utils import whisper_log_mel_batch
+
+# (kernel_size, stride, padding) of the convolutions in front of the quantizer of speech_tokenizer_v1.onnx
+SPEECH_TOKENIZER_CONVS = ((3, 1, 1), (3, 2, 1))
+
+
+def _run_speech_tokenizer(ort_session: onnxruntime.InferenceSession, feat: torch.Tensor) -> np.ndarray:
+    """Tokenize a batch of log mel features of the same length, returns (batch, token_len) tokens."""
+    return ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
+                                  ort_session.get_inputs()[1].name: np.array([feat.shape[2]] * feat.shape[0], dtype=np.int32)})[0]
+
+
+def extract_speech_token(ort_session: onnxruntime.InferenceSession, speech: torch.Tensor, sample_rate: int = 16000,
+                         max_chunk_sec: int = 30, overlap_sec: int = 2, batch_size: int = 16) -> List[int]:
+    """Extract speech tokens of a 16k mono waveform with the speech tokenizer onnx model.
+
+    The tokenizer only accepts up to 30s of audio. Longer audio is cut into
+    windows of max_chunk_sec seconds which overlap by overlap_sec seconds, the
+    last window is zero padded, so all windows have the same length and are
+    tokenized together in ort runs of batch_size windows. Neighbouring windows
+    are stitched at the middle of their overlap, where both have enough
+    context on each side. Audio not longer than max_chunk_sec is tokenized in
+    one run as before.
+
+    Args:
+        speech: (1, time) waveform.
+        max_chunk_sec: window length, whole seconds keep windows on the token grid.
+        overlap_sec: overlap of neighbouring windows, must be even and smaller than max_chunk_sec.
+
+    Returns:
+        list of speech tokens.
+    """
+    assert speech.dim() == 2 and speech.shape[0] == 1, 'expect a (1, time) mono waveform'
+    assert max_chunk_sec <= 30 and overlap_sec % 2 == 0 and 0 <= overlap_sec < max_chunk_sec
+    num_samples = speech.shape[1]
+    chunk_len = max_chunk_sec * sample_rate
+    if num_samples <= chunk_len:
+        feat = whisper_log_mel_batch([speech[0]], n_mels=128)[0].unsqueeze(dim=0)
+        return _run_speech_tokenizer(ort_session, feat).flatten().tolist()
+
+    hop_len = (max_chunk_sec - overlap_sec) * sample_rate
+    num_chunks = math.ceil((num_samples - chunk_len) / hop_len) + 1
+    speech = F.pad(speech, (0, (num_chunks - 1) * hop_len + chunk_len - num_samples))
+    chunks = speech[0].unfold(0, chunk_len, hop_len)
+    tokens = []
+    for i in range(0, num_chunks, batch_size):
+        # the log mel range is clamped per window, as if every window was tokenized on its own
+        feat = torch.stack(whisper_log_mel_batch(list(chunks[i: i + batch_size]), n_mels=128), dim=0)
+        tokens.append(_run_speech_tokenizer(ort_session, feat))
+    tokens = np.concatenate(tokens, axis=0)
+
+    # every window yields the same number of tokens, so token offsets follow from sample offsets
+    token_per_sec = tokens.shape[1] // max_chunk_sec
+    half_overlap = overlap_sec // 2 * token_per_sec
+    hop_token = (max_chunk_sec - overlap_sec) * token_per_sec
+    speech_token = [tokens[0, :hop_token + half_overlap]]
+    for i in range(1, num_chunks):
+        speech_token.append(tokens[i, half_overlap: half_overlap + hop_token])
+    speech_token = np.concatenate(speech_token, axis=0)
+    # drop the tokens of the zero padding
+    return speech_token[:math.ceil(num_samples * token_per_sec / sample_rate)].tolist()
+
+
+def speech_token_length(num_frames: int) -> int:
+    """Number of speech tokens of num_frames log mel frames, by the output length of the tokenizer convolutions."""
+    for kernel_size, stride, padding in SPEECH_TOKENIZER_CONVS:
+        num_frames = (num_frames + 2 * padding - kernel_size) // stride + 1
+    return num_frames
+
+
+def tokenize_batch(ort_session: onnxruntime.InferenceSession, feats: List[torch.Tensor]) -> List[List[int]]:
+    """Tokenize log mel features of different lengths, each at most 30s, in one ort run.
+
+    The features are right padded with zeros, the tokenizer masks the padding
+    by its feats_length input and the tokens of the padding are dropped, every
+    feature keeps speech_token_length of its frames, as if it was tokenized alone.
+
+    Args:
+        feats: list of (128, frames) whisper log mel features.
+    """
+    lengths = [feat.shape[1] for feat in feats]
+    max_len = max(lengths)
+    feat = torch.stack([F.pad(feat, (0, max_len - feat.shape[1])) for feat in feats], dim=0)
+    tokens = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
+                                    ort_session.get_inputs()[1].name: np.array(lengths, dtype=np.int32)})[0]
+    assert tokens.shape[1] == speech_token_length(max_len), 'speech tokenizer downsampling differs from SPEECH_TOKENIZER_CONVS'
+    return [tokens[i, :speech_token_length(length)].tolist() for i, length in enumerate(lengths)]
+
+
+class SpeechTokenShardWriter:
+    """Append only writer of speech token shards, one `utt token token ...` line per utterance.
+
+    Every writer starts a new shard in shard_dir and rotates to another one
+    after utts_per_shard lines, so an interrupted run never appends after a
+    partially written line. After flush, load_speech_token_shards finds all
+    utterances written so far, even if the process crashes later.
+    """
+
+    def __init__(self, shard_dir: str, utts_per_shard: int = 100000):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.utts_per_shard = utts_per_shard
+        self.shard_index = len([f for f in os.listdir(shard_dir) if f.endswith('.txt')])
+        self.f, self.num_utts = None, 0
+
+    def write(self, utt: str, speech_token: List[int]):
+        if self.f is None or self.num_utts == self.utts_per_shard:
+            self.close()
+            self.f = open(os.path.join(self.shard_dir, 'shard_{:05d}.txt'.format(self.shard_index)), 'w', encoding='utf8')
+            self.shard_index += 1
+            self.num_utts = 0
+        self.f.write(' '.join([utt] + [str(i) for i in speech_token]) + '\n')
+        self.num_utts += 1
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def load_speech_token_shards(shard_dir: str) -> Dict[str, List[int]]:
+    """Read the shards written by SpeechTokenShardWriter, a partially written last line is skipped."""
+    utt2speech_token = {}
+    for name in sorted(os.listdir(shard_dir)):
+        if not name.endswith('.txt'):
+            continue
+        with open(os.path.join(shard_dir, name), 'r', encoding='utf8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                line = line.split()
+                utt2speech_token[line[0]] = [int(i) for i in line[1:]]
+    return utt2speech_token
+
+
+def load_speech_token(data_dir: str) -> Dict[str, List[int]]:
+    """Load the speech tokens of data_dir, written as shards or as the legacy utt2speech_token.pt."""
+    if os.path.isdir(os.path.join(data_dir, 'utt2speech_token')):
+        return load_speech_token_shards(os.path.join(data_dir, 'utt2speech_token'))
+    return torch.load(os.path.join(data_dir, 'utt2speech_token.pt'))
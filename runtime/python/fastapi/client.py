@@ -20,6 +20,17 @@ import numpy as np
 
 
 def main():
+    if args.mode == 'add_voice':
+        url = "http://{}:{}/add_voice".format(args.host, args.port)
+        payload = {
+            'voice_id': args.spk_id,
+            'prompt_text': args.prompt_text
+        }
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        response = requests.request("POST", url, data=payload, files=files)
+        response.raise_for_status()
+        logging.info('added voice {}, use it with --mode sft --spk_id {}'.format(args.spk_id, args.spk_id))
+        return
     url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
     if args.mode == 'sft':
         payload = {
@@ -66,14 +77,15 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'add_voice'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
     parser.add_argument('--spk_id',
                         type=str,
-                        default='中文女')
+                        default='中文女',
+                        help='speaker id, or the id of the voice to enroll in add_voice mode')
     parser.add_argument('--prompt_text',
                         type=str,
                         default='希望你以后能够做的比我还好呦。')
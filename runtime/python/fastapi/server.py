@@ -16,9 +16,11 @@ import sys
 import argparse
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+import threading
+from fastapi import FastAPI, UploadFile, Form, File, Request, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import uvicorn
 import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -37,36 +39,59 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+async def generate_data(model_output, request: Request, cancel_event: threading.Event):
+    try:
+        async for i in iterate_in_threadpool(model_output):
+            if await request.is_disconnected():
+                break
+            tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+            yield tts_audio
+    finally:
+        # response is done or client disconnected, stop in flight synthesis and release its model session,
+        # the generator runs in the threadpool, so it is closed there too
+        cancel_event.set()
+        await run_in_threadpool(model_output.close)
+
+
+@app.post("/add_voice")
+async def add_voice(voice_id: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+    prompt_speech_16k = await run_in_threadpool(load_wav, prompt_wav.file, 16000)
+    try:
+        # feature extraction and saving block, keep them off the event loop of the streaming responses
+        await run_in_threadpool(cosyvoice.add_voice, voice_id, prompt_text, prompt_speech_16k)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {'voice_id': voice_id}
 
 
 @app.get("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+async def inference_sft(request: Request, tts_text: str = Form(), spk_id: str = Form()):
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, request, cancel_event))
 
 
 @app.get("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_zero_shot(request: Request, tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, request, cancel_event))
 
 
 @app.get("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_cross_lingual(request: Request, tts_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, request, cancel_event))
 
 
 @app.get("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct(request: Request, tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
+    cancel_event = threading.Event()
+    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text, cancel_event=cancel_event)
+    return StreamingResponse(generate_data(model_output, request, cancel_event))
 
 
 if __name__ == '__main__':
@@ -78,6 +103,19 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--llm_max_batch_size',
+                        type=int,
+                        default=1,
+                        help='decode speech tokens of up to this many concurrent requests in one batch, 1 means disabled')
+    parser.add_argument('--prompt_cache_dir',
+                        type=str,
+                        default=None,
+                        help='persist prompt features of reference voices in this directory')
+    parser.add_argument('--voice_dir',
+                        type=str,
+                        default=None,
+                        help='persist voices enrolled by /add_voice in this directory')
     args = parser.parse_args()
-    cosyvoice = CosyVoice(args.model_dir)
+    cosyvoice = CosyVoice(args.model_dir, llm_max_batch_size=args.llm_max_batch_size, prompt_cache_dir=args.prompt_cache_dir,
+                          voice_dir=args.voice_dir)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -30,6 +30,14 @@ from cosyvoice.utils.file_utils import load_wav
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+        if args.mode == 'add_voice':
+            logging.info('send add_voice request')
+            prompt_speech = load_wav(args.prompt_wav, 16000)
+            response = stub.AddVoice(cosyvoice_pb2.addVoiceRequest(voice_id=args.spk_id,
+                                                                   prompt_text=args.prompt_text,
+                                                                   prompt_audio=(prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()))
+            logging.info('added voice {}, use it with --mode sft --spk_id {}'.format(response.voice_id, response.voice_id))
+            return
         request = cosyvoice_pb2.Request()
         if args.mode == 'sft':
             logging.info('send sft request')
@@ -80,14 +88,15 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'add_voice'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
     parser.add_argument('--spk_id',
                         type=str,
-                        default='中文女')
+                        default='中文女',
+                        help='speaker id, or the id of the voice to enroll in add_voice mode')
     parser.add_argument('--prompt_text',
                         type=str,
                         default='希望你以后能够做的比我还好呦。')
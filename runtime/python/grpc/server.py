@@ -15,6 +15,7 @@ import os
 import sys
 from concurrent import futures
 import argparse
+import threading
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
 import logging
@@ -33,33 +34,53 @@ logging.basicConfig(level=logging.DEBUG,
 
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        self.cosyvoice = CosyVoice(args.model_dir)
+        self.cosyvoice = CosyVoice(args.model_dir, llm_max_batch_size=args.llm_max_batch_size, prompt_cache_dir=args.prompt_cache_dir,
+                                   voice_dir=args.voice_dir)
         logging.info('grpc service initialized')
 
+    def AddVoice(self, request, context):
+        logging.info('get add voice request {}'.format(request.voice_id))
+        prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+        prompt_speech_16k = prompt_speech_16k.float() / (2**15)
+        try:
+            self.cosyvoice.add_voice(request.voice_id, request.prompt_text, prompt_speech_16k)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return cosyvoice_pb2.addVoiceResponse(voice_id=request.voice_id)
+
     def Inference(self, request, context):
+        # set when the rpc terminates, e.g. client cancels or disconnects, stops in flight synthesis
+        cancel_event = threading.Event()
+        context.add_callback(cancel_event.set)
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id, cancel_event=cancel_event)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
             model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
                                                               request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+                                                              prompt_speech_16k,
+                                                              cancel_event=cancel_event)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k,
+                                                                  cancel_event=cancel_event)
         else:
             logging.info('get instruct inference request')
             model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
                                                              request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+                                                             request.instruct_request.instruct_text,
+                                                             cancel_event=cancel_event)
 
         logging.info('send inference response')
         for i in model_output:
+            if not context.is_active():
+                cancel_event.set()
+                break
             response = cosyvoice_pb2.Response()
             response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
             yield response
@@ -86,5 +107,17 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--llm_max_batch_size',
+                        type=int,
+                        default=1,
+                        help='decode speech tokens of up to this many concurrent requests in one batch, 1 means disabled')
+    parser.add_argument('--prompt_cache_dir',
+                        type=str,
+                        default=None,
+                        help='persist prompt features of reference voices in this directory')
+    parser.add_argument('--voice_dir',
+                        type=str,
+                        default=None,
+                        help='persist voices enrolled by AddVoice in this directory')
     args = parser.parse_args()
     main()
@@ -13,41 +13,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 import onnxruntime
 import torch
 import torchaudio
-import torchaudio.compliance.kaldi as kaldi
 from tqdm import tqdm
+from cosyvoice.utils.audio_utils import resample
+from cosyvoice.utils.embedding_utils import (bucket_by_length, campplus_num_frames, compute_campplus_fbank, create_embedding_table,
+                                             extract_spk_embedding)
 
 
-def single_job(utt):
-    audio, sample_rate = torchaudio.load(utt2wav[utt])
-    if sample_rate != 16000:
-        audio = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)(audio)
-    feat = kaldi.fbank(audio,
-                       num_mel_bins=80,
-                       dither=0,
-                       sample_frequency=16000)
-    feat = feat - feat.mean(dim=0, keepdim=True)
-    embedding = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
-    return utt, embedding
+def init_session(onnx_path, num_intra_thread):
+    # every worker process owns its session
+    global ort_session
+    option = onnxruntime.SessionOptions()
+    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    option.intra_op_num_threads = num_intra_thread
+    providers = ["CPUExecutionProvider"]
+    ort_session = onnxruntime.InferenceSession(onnx_path, sess_options=option, providers=providers)
+
+
+def num_frames_job(utt):
+    info = torchaudio.info(utt2wav[utt])
+    return campplus_num_frames(info.num_frames, info.sample_rate)
+
+
+def batch_job(utts, pad):
+    feats = []
+    for utt in utts:
+        audio, sample_rate = torchaudio.load(utt2wav[utt])
+        if sample_rate != 16000:
+            audio = resample(audio, sample_rate, 16000)
+        feats.append(compute_campplus_fbank(audio))
+    return utts, extract_spk_embedding(ort_session, feats, pad=pad)
 
 
 def main(args):
-    all_task = [executor.submit(single_job, utt) for utt in utt2wav.keys()]
-    utt2embedding, spk2embedding = {}, {}
-    for future in tqdm(as_completed(all_task)):
-        utt, embedding = future.result()
-        utt2embedding[utt] = embedding
-        spk = utt2spk[utt]
-        if spk not in spk2embedding:
-            spk2embedding[spk] = []
-        spk2embedding[spk].append(embedding)
-    for k, v in spk2embedding.items():
-        spk2embedding[k] = torch.tensor(v).mean(dim=0).tolist()
-    torch.save(utt2embedding, "{}/utt2embedding.pt".format(args.dir))
-    torch.save(spk2embedding, "{}/spk2embedding.pt".format(args.dir))
+    utts = list(utt2wav.keys())
+    utt2index = {utt: i for i, utt in enumerate(utts)}
+    # utterances of the same fbank length are batched, max_pad_ratio > 1.0 also pads similar lengths
+    num_frames = list(executor.map(num_frames_job, utts, chunksize=256))
+    batches = bucket_by_length(num_frames, batch_size=args.batch_size, max_pad_ratio=args.max_pad_ratio)
+    all_task = [executor.submit(batch_job, [utts[i] for i in batch], args.max_pad_ratio > 1.0) for batch in batches]
+    utt2embedding, spk2embedding, spk2num = None, {}, {}
+    for future in tqdm(as_completed(all_task), total=len(all_task)):
+        batch_utts, embeddings = future.result()
+        if utt2embedding is None:
+            if args.format == 'npy':
+                utt2embedding = create_embedding_table('{}/utt2embedding'.format(args.dir), utts, embeddings.shape[1])
+            else:
+                utt2embedding = {}
+        for utt, embedding in zip(batch_utts, embeddings):
+            if args.format == 'npy':
+                utt2embedding[utt2index[utt]] = embedding
+            else:
+                utt2embedding[utt] = embedding.tolist()
+            spk = utt2spk[utt]
+            if spk not in spk2embedding:
+                spk2embedding[spk], spk2num[spk] = np.zeros_like(embedding, dtype=np.float64), 0
+            spk2embedding[spk] += embedding
+            spk2num[spk] += 1
+    if utt2embedding is None:
+        logging.warning('no utterance in {}/wav.scp, write empty tables'.format(args.dir))
+        if args.format == 'npy':
+            dim = onnxruntime.InferenceSession(args.onnx_path, providers=["CPUExecutionProvider"]).get_outputs()[0].shape[-1]
+            utt2embedding = create_embedding_table('{}/utt2embedding'.format(args.dir), utts, dim)
+        else:
+            utt2embedding = {}
+    spks = list(spk2embedding.keys())
+    if args.format == 'npy':
+        utt2embedding.flush()
+        spk_table = create_embedding_table('{}/spk2embedding'.format(args.dir), spks, utt2embedding.shape[1])
+        for i, spk in enumerate(spks):
+            spk_table[i] = spk2embedding[spk] / spk2num[spk]
+        spk_table.flush()
+    else:
+        torch.save(utt2embedding, "{}/utt2embedding.pt".format(args.dir))
+        torch.save({spk: (spk2embedding[spk] / spk2num[spk]).tolist() for spk in spks}, "{}/spk2embedding.pt".format(args.dir))
 
 
 if __name__ == "__main__":
@@ -55,7 +99,17 @@ if __name__ == "__main__":
     parser.add_argument("--dir", type=str)
     parser.add_argument("--onnx_path", type=str)
     parser.add_argument("--num_thread", type=int, default=8)
+    parser.add_argument("--num_process", type=int, default=0,
+                        help="run num_process worker processes with one session each instead of num_thread threads sharing one session")
+    parser.add_argument("--num_intra_thread", type=int, default=1, help="intra op threads of every ort session")
+    parser.add_argument("--batch_size", type=int, default=32, help="max utterances per ort run")
+    parser.add_argument("--max_pad_ratio", type=float, default=1.0,
+                        help="max ratio of the longest to the shortest utterance of a batch, 1.0 only batches equal lengths and gives "
+                             "the embeddings of the frontend, larger values pad shorter utterances, which changes their embeddings")
+    parser.add_argument("--format", type=str, default='npy', choices=['npy', 'pt'],
+                        help="npy writes memory mapped {utt,spk}2embedding.npy with .list keys, pt writes the legacy torch dicts")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
     utt2wav, utt2spk = {}, {}
     with open('{}/wav.scp'.format(args.dir)) as f:
@@ -67,11 +121,11 @@ if __name__ == "__main__":
             l = l.replace('\n', '').split()
             utt2spk[l[0]] = l[1]
 
-    option = onnxruntime.SessionOptions()
-    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-    option.intra_op_num_threads = 1
-    providers = ["CPUExecutionProvider"]
-    ort_session = onnxruntime.InferenceSession(args.onnx_path, sess_options=option, providers=providers)
-    executor = ThreadPoolExecutor(max_workers=args.num_thread)
+    if args.num_process > 0:
+        # workers are forked after utt2wav is read, so they share it
+        executor = ProcessPoolExecutor(max_workers=args.num_process, initializer=init_session, initargs=(args.onnx_path, args.num_intra_thread))
+    else:
+        init_session(args.onnx_path, args.num_intra_thread)
+        executor = ThreadPoolExecutor(max_workers=args.num_thread)
 
     main(args)
@@ -13,45 +13,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import logging
+import os
+import time
 import torch
 from tqdm import tqdm
 import onnxruntime
-import numpy as np
 import torchaudio
-import whisper
+from cosyvoice.utils.audio_utils import resample, whisper_log_mel_batch
+from cosyvoice.utils.embedding_utils import bucket_by_length
+from cosyvoice.utils.speech_token_utils import SpeechTokenShardWriter, extract_speech_token, load_speech_token_shards, tokenize_batch
 
 
-def single_job(utt):
-    audio, sample_rate = torchaudio.load(utt2wav[utt])
-    if sample_rate != 16000:
-        audio = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)(audio)
-    if audio.shape[1] / 16000 > 30:
-        logging.warning('do not support extract speech token for audio longer than 30s')
-        speech_token = []
-    else:
-        feat = whisper.log_mel_spectrogram(audio, n_mels=128)
-        speech_token = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
-                                              ort_session.get_inputs()[1].name: np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
-    return utt, speech_token
+def feat_job(utt_wavs):
+    # runs in a worker process, decodes, resamples and computes log mel of a chunk of utterances
+    results = []
+    for utt, wav in utt_wavs:
+        audio, sample_rate = torchaudio.load(wav)
+        if sample_rate != 16000:
+            audio = resample(audio, sample_rate, 16000)
+        audio = audio[:1]
+        if audio.shape[1] / 16000 > 30:
+            # long audio is tokenized in overlapping windows by the main process
+            results.append((utt, None, audio))
+        else:
+            results.append((utt, whisper_log_mel_batch([audio[0]], n_mels=128)[0], None))
+    return results
+
+
+def tokenize_job(results, writer):
+    feats = [(utt, feat) for utt, feat, _ in results if feat is not None]
+    for batch in bucket_by_length([feat.shape[1] for _, feat in feats], batch_size=args.batch_size, max_pad_ratio=args.max_pad_ratio):
+        speech_tokens = tokenize_batch(ort_session, [feats[i][1] for i in batch])
+        for i, speech_token in zip(batch, speech_tokens):
+            writer.write(feats[i][0], speech_token)
+    for utt, _, audio in results:
+        if audio is not None:
+            writer.write(utt, extract_speech_token(ort_session, audio, batch_size=args.batch_size))
+    writer.flush()
 
 
 def main(args):
-    all_task = [executor.submit(single_job, utt) for utt in utt2wav.keys()]
-    utt2speech_token = {}
-    for future in tqdm(as_completed(all_task)):
-        utt, speech_token = future.result()
-        utt2speech_token[utt] = speech_token
-    torch.save(utt2speech_token, '{}/utt2speech_token.pt'.format(args.dir))
+    shard_dir = '{}/utt2speech_token'.format(args.dir)
+    done = load_speech_token_shards(shard_dir) if os.path.isdir(shard_dir) else {}
+    utts = [utt for utt in utt2wav.keys() if utt not in done]
+    logging.info('{} utts already tokenized, {} utts to go'.format(len(done), len(utts)))
+    chunks = [[(utt, utt2wav[utt]) for utt in utts[i: i + args.chunk_size]] for i in range(0, len(utts), args.chunk_size)]
+    writer = SpeechTokenShardWriter(shard_dir, utts_per_shard=args.utts_per_shard)
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.num_process) as executor, tqdm(total=len(utts), unit='utt') as progress:
+        # at most 2 chunks per worker are in flight, so decoded features do not pile up when ort is slower
+        pending, next_chunk = set(), 0
+        while next_chunk < len(chunks) or len(pending) != 0:
+            while next_chunk < len(chunks) and len(pending) < 2 * args.num_process:
+                pending.add(executor.submit(feat_job, chunks[next_chunk]))
+                next_chunk += 1
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results = future.result()
+                tokenize_job(results, writer)
+                progress.update(len(results))
+    writer.close()
+    logging.info('tokenized {} utts in {:.1f}s, {:.1f} utts/sec'.format(len(utts), time.time() - start_time,
+                                                                        len(utts) / max(time.time() - start_time, 1e-6)))
+    if args.save_pt is True:
+        torch.save(load_speech_token_shards(shard_dir), '{}/utt2speech_token.pt'.format(args.dir))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", type=str)
     parser.add_argument("--onnx_path", type=str)
-    parser.add_argument("--num_thread", type=int, default=8)
+    parser.add_argument("--num_process", type=int, default=8, help="worker processes decoding audio and computing log mel")
+    parser.add_argument("--chunk_size", type=int, default=256, help="utts per worker job, utts of a chunk are bucketed by length")
+    parser.add_argument("--batch_size", type=int, default=16, help="max utts per ort run")
+    parser.add_argument("--max_pad_ratio", type=float, default=1.2, help="max ratio of the longest to the shortest utt of a batch")
+    parser.add_argument("--utts_per_shard", type=int, default=100000)
+    parser.add_argument("--save_pt", action='store_true', help="also merge the shards into the legacy utt2speech_token.pt")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
     utt2wav = {}
     with open('{}/wav.scp'.format(args.dir)) as f:
@@ -64,6 +105,5 @@ if __name__ == "__main__":
     option.intra_op_num_threads = 1
     providers = ["CUDAExecutionProvider"]
     ort_session = onnxruntime.InferenceSession(args.onnx_path, sess_options=option, providers=providers)
-    executor = ThreadPoolExecutor(max_workers=args.num_thread)
 
     main(args)
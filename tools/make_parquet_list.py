@@ -20,7 +20,8 @@ from tqdm import tqdm
 import pandas as pd
 import multiprocessing
 import time
-import torch
+from cosyvoice.utils.embedding_utils import load_embedding_table
+from cosyvoice.utils.speech_token_utils import load_speech_token
 
 
 def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
@@ -83,9 +84,10 @@ if __name__ == "__main__":
         for l in f:
             l = l.replace('\n', '').split()
             utt2spk[l[0]] = l[1]
-    utt2embedding = torch.load('{}/utt2embedding.pt'.format(args.src_dir))
-    spk2embedding = torch.load('{}/spk2embedding.pt'.format(args.src_dir))
-    utt2speech_token = torch.load('{}/utt2speech_token.pt'.format(args.src_dir))
+    # npy tables of tools/extract_embedding.py are memory mapped, legacy .pt dicts are loaded
+    utt2embedding = load_embedding_table('{}/utt2embedding'.format(args.src_dir))
+    spk2embedding = load_embedding_table('{}/spk2embedding'.format(args.src_dir))
+    utt2speech_token = load_speech_token(args.src_dir)
     utts = list(utt2wav.keys())
 
     # Using process pool to speedup